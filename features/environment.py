@@ -0,0 +1,27 @@
+"""Give each scenario a configuration and a database of its own"""
+
+import os
+import shutil
+import tempfile
+
+
+CONFIG = """
+[Database]
+path = sqlite:///%(path)s
+
+[Server]
+host = localhost
+port = 8080
+"""
+
+
+def before_scenario(context, scenario):
+    context.folder = tempfile.mkdtemp(prefix='images-test-')
+    context.db_path = os.path.join(context.folder, 'images.db')
+    context.config_path = os.path.join(context.folder, 'images.ini')
+    with open(context.config_path, 'w') as f:
+        f.write(CONFIG % {'path': context.db_path})
+
+
+def after_scenario(context, scenario):
+    shutil.rmtree(context.folder, ignore_errors=True)
@@ -0,0 +1,54 @@
+Feature: Paging through the entry feed
+
+  Scenario: Entries without the sort property come last
+    Given a database
+      And entries with the ISOSpeedRatings 100, 800, none, 400 and none
+     When the feed sorted on ISOSpeedRatings is paged through 10 entries at a time
+     Then the feed lists the ISOSpeedRatings 800, 400, 100, none and none
+
+  Scenario: Entries are filtered on promoted properties
+    Given a database
+      And entries with the ISOSpeedRatings 100, 800, none, 400 and none
+     When the feed filtered on ISOSpeedRatings>=400 is paged through 10 entries at a time
+     Then the feed lists 2 entries
+
+  Scenario: Entries are sorted in ascending order with the missing ones last
+    Given a database
+      And entries with the ISOSpeedRatings 100, 800, none, 400 and none
+     When the feed sorted ascending on ISOSpeedRatings is paged through 10 entries at a time
+     Then the feed lists the ISOSpeedRatings 100, 400, 800, none and none
+
+  Scenario: Queries built in code have no property filters
+    Given a database
+      And entries with the ISOSpeedRatings 100 and none
+     When the feed is paged through 10 entries at a time
+     Then the feed lists 2 entries
+
+  Scenario Outline: Entries taken in the same second are each listed once
+    Given a database
+      And 10 entries taken at 2016-01-02 03:04:05
+     When the feed is paged through <page_size> entries at a time
+     Then the feed lists each entry once, the newest first
+     When the feed is paged back from the last page
+     Then the feed lists each entry once, the newest first
+
+    Examples:
+      | page_size |
+      | 1         |
+      | 3         |
+      | 10        |
+
+  Scenario: Entries created before the timestamps were set from Python
+    Given a database from before the import queue
+      And 4 more entries created at 2016-01-02 03:04:05 without fractional seconds
+     When the database is migrated
+      And the feed is paged through 2 entries at a time
+     Then the feed lists each entry once, the newest first
+     When the feed is paged back from the last page
+     Then the feed lists each entry once, the newest first
+
+  Scenario: Entries are sorted across pages
+    Given a database
+      And entries with the ISOSpeedRatings 100, 800, none, 400, 100, none, 400 and none
+     When the feed sorted on ISOSpeedRatings is paged through 2 entries at a time
+     Then the feed lists the ISOSpeedRatings 800, 400, 400, 100, 100, none, none and none
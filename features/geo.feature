@@ -0,0 +1,25 @@
+Feature: Finding geotagged entries on the map
+
+  Scenario: Geotagged photos are imported with their position
+    Given a database with image, thumb, proxy and drop locations
+      And a photo taken at 59.3293, 18.0686 in the drop folder
+     When the drop folder is registered and imported
+     Then the entry is online at 59.3293, 18.0686 in geohash cell u6sce
+      And the feed within 59,18,60,19 lists 1 entries
+      And the feed within -34,151,-33,152 lists 0 entries
+      And the feed near 59.33,18.07 lists 1 entries
+      And the clusters at zoom 10 count 1 entries in cell u6sce
+
+  Scenario: Photos taken west of Greenwich and south of the equator
+    Given a database with image, thumb, proxy and drop locations
+      And a photo taken at -22.9519, -43.2105 in the drop folder
+     When the drop folder is registered and imported
+     Then the entry is online at -22.9519, -43.2105 in geohash cell 75cm
+
+  Scenario: Positions given as text are stored as numbers
+    Given a database
+      And an entry at 59.3293, 18.0686 given as text
+     Then the entry is at 59.3293, 18.0686 in geohash cell u6sce
+     When the entry is updated
+     Then the entry is at 59.3293, 18.0686 in geohash cell u6sce
+      And the feed near 59.33,18.07 lists 1 entries
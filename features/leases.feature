@@ -0,0 +1,64 @@
+Feature: Claiming import work with leases
+
+  Background:
+    Given a database
+      And 5 entries waiting for import on location 1
+
+  Scenario: Workers claim disjoint batches
+     When worker A claims 3 entries on location 1
+      And worker B claims 3 entries on location 1
+     Then worker A holds 3 entries
+      And worker B holds 2 entries
+      And 0 entries are waiting for import on location 1
+
+  Scenario: Expired leases are returned to the queue
+     When worker A claims 2 entries on location 1
+      And the leases of worker A expire
+      And expired leases are reaped
+     Then 5 entries are waiting for import on location 1
+      And worker A holds 0 entries
+
+  Scenario: Entries that are out of attempts fail
+     When worker A claims 1 entries on location 1
+      And the leases of worker A expire
+      And expired leases are reaped with at most 1 attempts
+     Then 4 entries are waiting for import on location 1
+      And 1 entries have failed
+
+  Scenario: Leases are renewed while an import is running
+     When worker A claims 2 entries on location 1
+      And the leases of worker A expire
+      And worker A keeps its leases for 2 seconds
+      And expired leases are reaped
+     Then worker A holds 2 entries
+
+  Scenario: High priority entries are claimed first
+    Given 1 high priority entries waiting for import on location 1
+     When worker A claims 1 entries on location 1
+     Then worker A holds 1 high priority entries
+
+  Scenario: Entries that can not be written for now are put back in the queue
+     When worker A claims 1 entries on location 1
+      And worker A imports its entries while the database is locked
+     Then 5 entries are waiting for import on location 1
+      And worker A holds 0 entries
+
+  Scenario: Entries that can not be written at all fail
+     When worker A claims 1 entries on location 1
+      And worker A imports its entries while the entries can not be written
+     Then 4 entries are waiting for import on location 1
+      And 1 entries have failed
+      And worker A holds 0 entries
+
+  Scenario: A worker claiming again gets only the entries of the new claim
+     When worker A claims 2 entries on location 1
+      And worker A claims 2 entries on location 1
+     Then the claim returned 2 entries worker A had not claimed before
+      And worker A holds 4 entries
+
+  Scenario: Import rates count imports, not edits
+    Given 3 online entries on location 1
+     When worker A claims 2 entries on location 1
+      And worker A imports its entries
+      And the online entries are edited
+     Then location 1 imports 2.0 entries per minute
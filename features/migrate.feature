@@ -0,0 +1,17 @@
+Feature: Migrating databases from older versions
+
+  Scenario: Columns added to the models are added to existing tables
+    Given a database from before the import queue
+     When the database is migrated
+     Then the entry table has the columns worker_id, lease_ts, attempts, retry_ts, priority and import_ts
+      And the old entry has 0 attempts and normal priority
+
+  Scenario: Tag tables with integer ids are rebuilt with text ids
+    Given a database from before the import queue
+      And the old entry is linked twice to tag 7
+      And a link from a deleted entry to tag 7
+     When the database is migrated
+      And the old entry is tagged holiday
+     Then the old entry has the tags 7 and holiday
+      And tag 7 counts 1 entry
+      And tag holiday counts 1 entry
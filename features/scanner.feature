@@ -0,0 +1,36 @@
+Feature: Scanning drop folders
+
+  Scenario Outline: A file that is still being written is held back
+    Given a drop folder scanned with <workers> workers
+     When a.jpg is written to the drop folder
+      And the drop folder is scanned
+     Then the scan finds nothing
+     When more is written to a.jpg
+      And the drop folder is scanned
+     Then the scan finds nothing
+     When the drop folder is scanned
+     Then the scan finds a.jpg
+     When the drop folder is scanned
+     Then the scan finds nothing
+
+    Examples:
+      | workers |
+      | 1       |
+      | 4       |
+
+  Scenario: A file that was written a while ago is found right away
+    Given a drop folder scanned with 1 workers
+     When a.jpg is written to the drop folder a minute ago
+      And the drop folder is scanned
+     Then the scan finds a.jpg
+
+  Scenario: The managed paths are only read when there are files to register
+    Given a database with a drop location
+     When the drop location is scanned
+     Then the managed paths have been read 0 times
+     When a.jpg is written to the drop folder a minute ago
+      And the drop location is scanned
+     Then the managed paths have been read 1 times
+      And 1 entries have been registered
+     When the drop location is scanned
+     Then the managed paths have been read 1 times
@@ -0,0 +1,122 @@
+import sqlite3
+
+from behave import given, when, then
+
+from images.setup import Setup
+
+
+# Tables as created by the baseline version, before the import queue and
+# the indexes
+OLD_SCHEMA = """
+CREATE TABLE entry (
+    id INTEGER NOT NULL PRIMARY KEY,
+    original_filename VARCHAR(256),
+    source VARCHAR(64),
+    import_location_id INTEGER,
+    type INTEGER NOT NULL,
+    state INTEGER NOT NULL,
+    delete_ts DATETIME,
+    access INTEGER NOT NULL,
+    create_ts DATETIME,
+    update_ts DATETIME,
+    taken_ts DATETIME,
+    latitude FLOAT,
+    longitude FLOAT,
+    data VARCHAR(32768),
+    physical_data VARCHAR(32768),
+    user_id INTEGER NOT NULL,
+    parent_entry_id INTEGER
+);
+CREATE TABLE tag (
+    id INTEGER NOT NULL PRIMARY KEY,
+    title VARCHAR(128),
+    color INTEGER
+);
+CREATE TABLE entry_to_tag (
+    id INTEGER NOT NULL PRIMARY KEY,
+    entry_id INTEGER,
+    tag_id INTEGER
+);
+"""
+
+
+def connect(context):
+    return sqlite3.connect(context.db_path)
+
+
+@given('a database')
+def step_database(context):
+    context.setup = Setup(context.config_path)
+    context.setup.create_database_tables()
+
+
+@given('a database from before the import queue')
+def step_old_database(context):
+    with connect(context) as db:
+        db.executescript(OLD_SCHEMA)
+        # CURRENT_TIMESTAMP stores seconds only
+        db.execute(
+            "INSERT INTO entry (id, type, state, access, create_ts, update_ts, user_id) "
+            "VALUES (1, 0, 3, 0, '2016-01-02 03:04:05', '2016-01-02 03:04:05', 1)"
+        )
+
+
+@when('the database is migrated')
+def step_migrate(context):
+    context.setup = Setup(context.config_path)
+    context.setup.create_database_tables()
+
+
+@then('the {table} table has the columns {columns}')
+def step_has_columns(context, table, columns):
+    with connect(context) as db:
+        existing = {row[1] for row in db.execute("PRAGMA table_info(%s)" % table)}
+    for column in columns.replace(' and ', ', ').split(', '):
+        assert column in existing, "%s.%s is missing" % (table, column)
+
+
+@then('the old entry has {attempts:d} attempts and {priority} priority')
+def step_old_entry(context, attempts, priority):
+    from images.entry import _Entry
+    with connect(context) as db:
+        row = db.execute("SELECT attempts, priority FROM entry WHERE id = 1").fetchone()
+    assert row == (attempts, _Entry.Priority[priority]), row
+
+
+@given('the old entry is linked twice to tag {tag_id:d}')
+def step_old_tag_links(context, tag_id):
+    with connect(context) as db:
+        db.execute("INSERT INTO tag (id, title, color) VALUES (?, 'Old', 3)", (tag_id, ))
+        db.executemany(
+            "INSERT INTO entry_to_tag (entry_id, tag_id) VALUES (1, ?)",
+            [(tag_id, ), (tag_id, )],
+        )
+
+
+@given('a link from a deleted entry to tag {tag_id:d}')
+def step_orphan_tag_link(context, tag_id):
+    with connect(context) as db:
+        db.execute("INSERT INTO entry_to_tag (entry_id, tag_id) VALUES (2, ?)", (tag_id, ))
+
+
+@when('the old entry is tagged {tag}')
+def step_tag_old_entry(context, tag):
+    from images.entry import get_entry_by_id, update_entry_by_id
+    from images.tag import ensure_tag
+    ensure_tag(tag)
+    entry = get_entry_by_id(1)
+    entry.tags = entry.tags + [tag]
+    update_entry_by_id(1, entry, system=True)
+
+
+@then('the old entry has the tags {tags}')
+def step_old_entry_tags(context, tags):
+    from images.entry import get_entry_by_id
+    expected = tags.replace(' and ', ', ').split(', ')
+    assert sorted(get_entry_by_id(1).tags) == expected, get_entry_by_id(1).tags
+
+
+@then('tag {tag_id} counts {count:d} entry')
+def step_tag_count(context, tag_id, count):
+    from images.tag import get_tag_by_id
+    assert get_tag_by_id(tag_id).count == count, get_tag_by_id(tag_id).count
@@ -0,0 +1,122 @@
+import sqlite3
+import urllib.parse
+
+from behave import given, when, then
+
+from images.entry import Entry, EntryQuery, create_entries, get_entries
+from images.ingest.image import JPEGMetadata
+
+
+def cursor(link, name):
+    return urllib.parse.parse_qs(urllib.parse.urlparse(link).query)[name][0]
+
+
+def page_through(context, **options):
+    """
+    Follow the next links of the feed from the first page to the last.
+    Getting a feed moves the cursors of its query to the links, so every
+    page is got with a query of its own.
+    """
+    context.options = options
+    context.pages = []
+    context.listed = []
+    after = ''
+    while True:
+        feed = get_entries(EntryQuery(after=after, **options), system=True)
+        context.pages.append(feed.entries)
+        context.listed.extend(feed.entries)
+        if not feed.next_link:
+            break
+        after = cursor(feed.next_link, 'after')
+        assert len(context.listed) <= 100, "The feed does not end"
+    context.last_after = after
+
+
+def page_back(context):
+    """
+    Follow the previous links of the feed from the last page to the first.
+    """
+    options = context.options
+    feed = get_entries(EntryQuery(after=context.last_after, **options), system=True)
+    listed = list(feed.entries)
+    while feed.prev_link:
+        before = cursor(feed.prev_link, 'before')
+        feed = get_entries(EntryQuery(before=before, **options), system=True)
+        listed[:0] = feed.entries
+        assert len(listed) <= 100, "The feed does not end"
+    context.listed = listed
+
+
+@given('{count:d} entries taken at {ts}')
+def step_entries_taken_at(context, count, ts):
+    create_entries([Entry(taken_ts=ts) for _ in range(count)])
+    context.entry_count = count
+
+
+@given('{count:d} more entries created at {ts} without fractional seconds')
+def step_old_entries(context, count, ts):
+    with sqlite3.connect(context.db_path) as db:
+        for _ in range(count):
+            db.execute(
+                "INSERT INTO entry (type, state, access, create_ts, update_ts, user_id) "
+                "VALUES (0, 3, 0, ?, ?, 1)", (ts, ts)
+            )
+        context.entry_count = db.execute("SELECT COUNT(*) FROM entry").fetchone()[0]
+
+
+@given('entries with the {name} {values}')
+def step_entries_with(context, name, values):
+    eds = []
+    for value in values.replace(' and ', ', ').split(', '):
+        physical_metadata = JPEGMetadata()
+        if value != 'none':
+            setattr(physical_metadata, name, int(value))
+        eds.append(Entry(physical_metadata=physical_metadata))
+    create_entries(eds)
+
+
+@when('the feed sorted on {name} is paged through {page_size:d} entries at a time')
+def step_page_sorted(context, name, page_size):
+    page_through(context, page_size=page_size, sort=name)
+
+
+@when('the feed filtered on {expression} is paged through {page_size:d} entries at a time')
+def step_page_filtered(context, expression, page_size):
+    page_through(context, page_size=page_size, property_filters=[expression])
+
+
+@then('the feed lists the {name} {values}')
+def step_lists_values(context, name, values):
+    listed = [
+        str(getattr(entry.physical_metadata, name, None) or 'none')
+        for entry in context.listed
+    ]
+    assert listed == values.replace(' and ', ', ').split(', '), listed
+
+
+@then('the feed lists {count:d} entries')
+def step_lists_count(context, count):
+    assert len(context.listed) == count, len(context.listed)
+
+
+@when('the feed sorted ascending on {name} is paged through {page_size:d} entries at a time')
+def step_page_sorted_ascending(context, name, page_size):
+    page_through(context, page_size=page_size, sort=name, order='asc')
+
+
+@when('the feed is paged through {page_size:d} entries at a time')
+def step_page(context, page_size):
+    page_through(context, page_size=page_size)
+
+
+@when('the feed is paged back from the last page')
+def step_page_back(context):
+    page_back(context)
+
+
+@then('the feed lists each entry once, the newest first')
+def step_lists_each_once(context):
+    # Taken in the same second, so the newest is the one created last
+    ids = [entry.id for entry in context.listed]
+    assert ids == sorted(ids, reverse=True), ids
+    assert len(ids) == context.entry_count, ids
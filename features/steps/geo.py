@@ -0,0 +1,109 @@
+import os
+
+from behave import given, when, then
+from PIL import Image
+from samtt import get_db
+
+from images.entry import (
+    Entry, ClusterQuery, EntryQuery, _Entry,
+    create_entries, get_clusters, get_entries, get_entry_by_id, update_entry_by_id,
+)
+from images.importer import claim_import_ready_entries, import_entry
+from images.ingest.image import JPEGMetadata
+from images.location import Location, _Location, create_location
+from images.scanner import register_files
+from images.setup import Setup
+
+
+def dms(value):
+    """
+    Degrees, minutes and seconds as EXIF has them.
+    """
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    return (float(degrees), float(minutes), round((value - degrees - minutes / 60) * 3600, 2))
+
+
+@given('a database with image, thumb, proxy and drop locations')
+def step_locations(context):
+    context.setup = Setup(context.config_path)
+    context.setup.create_database_tables()
+    for name in ('image', 'thumb', 'proxy', 'drop'):
+        folder = os.path.join(context.folder, name)
+        os.makedirs(folder)
+        location = create_location(Location(
+            name=name,
+            type=name,
+            metadata=_Location.DefaultLocationMetadata(folder=folder, user_id=1),
+        ))
+        if name == 'drop':
+            context.drop = location
+
+
+@given('a photo taken at {latitude:g}, {longitude:g} in the drop folder')
+def step_photo(context, latitude, longitude):
+    exif = Image.Exif()
+    exif[0x8825] = {  # GPS IFD
+        1: 'N' if latitude >= 0 else 'S',
+        2: dms(latitude),
+        3: 'E' if longitude >= 0 else 'W',
+        4: dms(longitude),
+    }
+    image = Image.new('RGB', (64, 48), 'red')
+    image.save(os.path.join(context.drop.metadata.folder, 'photo.jpg'), exif=exif)
+
+
+@when('the drop folder is registered and imported')
+def step_register_and_import(context):
+    register_files(context.drop, ['photo.jpg'])
+    entries = claim_import_ready_entries(context.drop.id, 'test')
+    assert len(entries) == 1, entries
+    import_entry(entries[0])
+    context.entry_id = entries[0].id
+
+
+@given('an entry at {latitude}, {longitude} given as text')
+def step_entry_as_text(context, latitude, longitude):
+    physical_metadata = JPEGMetadata(Latitude=latitude, Longitude=longitude)
+    context.entry_id, = create_entries([Entry(physical_metadata=physical_metadata)])
+
+
+@when('the entry is updated')
+def step_update(context):
+    entry = get_entry_by_id(context.entry_id)
+    update_entry_by_id(context.entry_id, entry, system=True)
+
+
+@then('the entry is online at {latitude:g}, {longitude:g} in geohash cell {cell}')
+def step_online_at(context, latitude, longitude, cell):
+    entry = get_entry_by_id(context.entry_id)
+    assert entry.state == _Entry.State.online, (entry.state, entry.metadata.to_json())
+    step_at(context, latitude, longitude, cell)
+
+
+@then('the entry is at {latitude:g}, {longitude:g} in geohash cell {cell}')
+def step_at(context, latitude, longitude, cell):
+    with get_db().transaction() as t:
+        entry = t.query(_Entry).get(context.entry_id)
+        position = (round(entry.latitude, 4), round(entry.longitude, 4))
+        assert position == (latitude, longitude), position
+        assert entry.geohash.startswith(cell), entry.geohash
+
+
+@then('the feed within {bbox} lists {count:d} entries')
+def step_within(context, bbox, count):
+    feed = get_entries(EntryQuery(bbox=bbox), system=True)
+    assert feed.count == count, feed.count
+
+
+@then('the feed near {near} lists {count:d} entries')
+def step_near(context, near, count):
+    feed = get_entries(EntryQuery(near=near), system=True)
+    assert feed.count == count, feed.count
+
+
+@then('the clusters at zoom {zoom:d} count {count:d} entries in cell {cell}')
+def step_clusters(context, zoom, count, cell):
+    feed = get_clusters(ClusterQuery(zoom=zoom), system=True)
+    assert [(c.geohash, c.count) for c in feed.entries] == [(cell, count)], feed.to_json()
@@ -0,0 +1,159 @@
+import time
+import datetime
+from unittest import mock
+
+from behave import given, when, then
+from samtt import get_db
+from sqlalchemy.exc import OperationalError
+
+from images.entry import Entry, _Entry, create_entries, get_entry_by_id, update_entry_by_id
+from images.importer import (
+    claim_import_ready_entries,
+    get_import_rates,
+    import_entry,
+    keep_leases,
+    reap_expired_leases,
+)
+
+
+def count_entries(**filters):
+    with get_db().transaction() as t:
+        return t.query(_Entry).filter_by(**filters).count()
+
+
+@given('{count:d} entries waiting for import on location {location_id:d}')
+def step_waiting_entries(context, count, location_id):
+    create_entries([
+        Entry(
+            original_filename='%i.jpg' % n,
+            state=_Entry.State.import_ready,
+            import_location_id=location_id,
+        ) for n in range(count)
+    ])
+
+
+@when('worker {worker_id} claims {count:d} entries on location {location_id:d}')
+def step_claim(context, worker_id, count, location_id):
+    context.earlier = [entry.id for entry in getattr(context, 'claimed', [])]
+    context.claimed = claim_import_ready_entries(location_id, worker_id, limit=count)
+
+
+@when('the leases of worker {worker_id} expire')
+def step_expire(context, worker_id):
+    past = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+    with get_db().transaction() as t:
+        t.query(_Entry).filter(_Entry.worker_id == worker_id).update(
+            {_Entry.lease_ts: past}, synchronize_session=False)
+
+
+@when('expired leases are reaped')
+def step_reap(context):
+    reap_expired_leases()
+
+
+@when('expired leases are reaped with at most {max_attempts:d} attempts')
+def step_reap_attempts(context, max_attempts):
+    reap_expired_leases(max_attempts)
+
+
+@when('worker {worker_id} keeps its leases for {seconds:d} seconds')
+def step_keep_leases(context, worker_id, seconds):
+    # Renewed every second, for four seconds from then
+    with keep_leases(worker_id, lease_time=4):
+        time.sleep(seconds)
+
+
+@then('worker {worker_id} holds {count:d} entries')
+def step_holds(context, worker_id, count):
+    held = count_entries(worker_id=worker_id, state=_Entry.State.importing)
+    assert held == count, held
+
+
+@then('{count:d} entries are waiting for import on location {location_id:d}')
+def step_waiting(context, count, location_id):
+    waiting = count_entries(
+        import_location_id=location_id, state=_Entry.State.import_ready)
+    assert waiting == count, waiting
+
+
+@then('{count:d} entries have failed')
+def step_failed(context, count):
+    failed = count_entries(state=_Entry.State.import_failed)
+    assert failed == count, failed
+
+
+@given('{count:d} {priority} priority entries waiting for import on location {location_id:d}')
+def step_waiting_priority_entries(context, count, priority, location_id):
+    create_entries([
+        Entry(
+            original_filename='%s-%i.jpg' % (priority, n),
+            state=_Entry.State.import_ready,
+            import_location_id=location_id,
+            priority=_Entry.Priority[priority],
+        ) for n in range(count)
+    ])
+
+
+@then('worker {worker_id} holds {count:d} {priority} priority entries')
+def step_holds_priority(context, worker_id, count, priority):
+    held = count_entries(
+        worker_id=worker_id,
+        state=_Entry.State.importing,
+        priority=_Entry.Priority[priority],
+    )
+    assert held == count, held
+
+
+WRITE_ERRORS = {
+    'the database is locked': OperationalError(
+        'UPDATE entry', {}, Exception('database is locked')),
+    'the entries can not be written': TypeError('not a position'),
+}
+
+
+@when('worker {worker_id} imports its entries while {condition}')
+def step_import_failing_write(context, worker_id, condition):
+    # The import itself goes well, writing the entry does not
+    with mock.patch('images.importer._import_entry', return_value={}), \
+            mock.patch.object(Entry, 'map_out', side_effect=WRITE_ERRORS[condition]):
+        for entry in context.claimed:
+            import_entry(entry)
+
+
+@then('the claim returned {count:d} entries worker {worker_id} had not claimed before')
+def step_claimed_new(context, count, worker_id):
+    ids = [entry.id for entry in context.claimed]
+    assert len(ids) == count, ids
+    assert not set(ids) & set(context.earlier), (ids, context.earlier)
+
+
+@given('{count:d} online entries on location {location_id:d}')
+def step_online_entries(context, count, location_id):
+    context.online = create_entries([
+        Entry(
+            original_filename='online-%i.jpg' % n,
+            state=_Entry.State.online,
+            import_location_id=location_id,
+        ) for n in range(count)
+    ])
+
+
+@when('worker {worker_id} imports its entries')
+def step_import(context, worker_id):
+    with mock.patch('images.importer._import_entry', return_value={}):
+        for entry in context.claimed:
+            import_entry(entry)
+
+
+@when('the online entries are edited')
+def step_edit(context):
+    for id in context.online:
+        entry = get_entry_by_id(id)
+        entry.original_filename = 'edited-%i.jpg' % id
+        update_entry_by_id(id, entry, system=True)
+
+
+@then('location {location_id:d} imports {rate:g} entries per minute')
+def step_rate(context, location_id, rate):
+    rates = get_import_rates()[location_id]
+    assert rates['1min'] == rate, rates
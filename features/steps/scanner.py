@@ -0,0 +1,93 @@
+import os
+import time
+from unittest import mock
+
+from behave import given, when, then
+from samtt import get_db
+
+from images.entry import _Entry
+from images.file import KnownPaths
+from images.location import Location, _Location, create_location
+from images.scanner import FolderScanner, scan
+from images.setup import Setup
+
+
+@given('a drop folder scanned with {workers:d} workers')
+def step_drop_folder(context, workers):
+    context.drop_folder = os.path.join(context.folder, 'drop')
+    os.makedirs(context.drop_folder)
+    context.scanner = FolderScanner(context.drop_folder, workers=workers)
+
+
+@when('{name} is written to the drop folder')
+def step_write(context, name):
+    with open(os.path.join(context.drop_folder, name), 'wb') as f:
+        f.write(b'\xff\xd8' + b'\0' * 1024)
+
+
+@when('{name} is written to the drop folder a minute ago')
+def step_write_old(context, name):
+    step_write(context, name)
+    then = time.time() - 60
+    os.utime(os.path.join(context.drop_folder, name), (then, then))
+
+
+@when('more is written to {name}')
+def step_append(context, name):
+    with open(os.path.join(context.drop_folder, name), 'ab') as f:
+        f.write(b'\0' * 1024)
+
+
+@when('the drop folder is scanned')
+def step_scan(context):
+    context.found = sorted(context.scanner.scan())
+
+
+@then('the scan finds nothing')
+def step_found_nothing(context):
+    assert context.found == [], context.found
+
+
+@then('the scan finds {names}')
+def step_found(context, names):
+    assert context.found == names.split(', '), context.found
+
+
+@given('a database with a drop location')
+def step_drop_location(context):
+    context.setup = Setup(context.config_path)
+    context.setup.create_database_tables()
+    context.drop_folder = os.path.join(context.folder, 'drop')
+    os.makedirs(context.drop_folder)
+    context.location = create_location(Location(
+        name='drop',
+        type='drop',
+        metadata=_Location.DefaultLocationMetadata(folder=context.drop_folder, user_id=1),
+    ))
+    context.scanner = FolderScanner(context.drop_folder)
+    context.loads = 0
+
+
+@when('the drop location is scanned')
+def step_scan_location(context):
+    load = KnownPaths.load
+
+    def counted_load(known):
+        context.loads += 1
+        load(known)
+
+    with mock.patch.object(KnownPaths, 'load', counted_load):
+        scan(context.location, context.scanner)
+
+
+@then('the managed paths have been read {count:d} times')
+def step_loads(context, count):
+    assert context.loads == count, context.loads
+
+
+@then('{count:d} entries have been registered')
+def step_registered(context, count):
+    with get_db().transaction() as t:
+        registered = t.query(_Entry).filter(
+            _Entry.state == _Entry.State.import_ready).count()
+    assert registered == count, registered
@@ -0,0 +1,29 @@
+from behave import given, when, then
+
+from images.entry import Entry, EntryQuery, create_entries, get_tag_facets
+
+
+def split(values):
+    return values.replace(' and ', ', ').split(', ')
+
+
+@given('an entry tagged {tags}')
+def step_tagged_entry(context, tags):
+    create_entries([Entry(tags=split(tags))])
+
+
+@when('the tag facets are counted')
+def step_count_facets(context):
+    context.facets = get_tag_facets(EntryQuery(), system=True)
+
+
+@when('the tag facets are counted with {filter} {tags}')
+def step_count_facets_within(context, filter, tags):
+    query = EntryQuery(**{filter: split(tags)})
+    context.facets = get_tag_facets(query, system=True)
+
+
+@then('the facets are {facets}')
+def step_facets(context, facets):
+    counted = ['%s %i' % (facet.id, facet.count) for facet in context.facets.entries]
+    assert counted == split(facets), counted
@@ -0,0 +1,61 @@
+import io
+import os
+from types import SimpleNamespace
+from unittest import mock
+
+import bottle
+from behave import given, when, then
+from samtt import get_db
+
+from images import importer
+from images.entry import _Entry
+from images.importer import claim_import_ready_entries
+from images.location import Location, _Location, create_location
+from images.user import _User
+
+
+@given('an upload location')
+def step_upload_location(context):
+    folder = os.path.join(context.folder, 'upload')
+    context.upload = create_location(Location(
+        name='upload',
+        type='upload',
+        metadata=_Location.DefaultLocationMetadata(folder=folder),
+    ))
+
+
+@when('a photo is uploaded while worker {worker_id} claims entries on the upload location')
+def step_upload(context, worker_id):
+    data = b'\xff\xd8' + b'\0' * 1024
+    bottle.request.bind({
+        'REQUEST_METHOD': 'POST',
+        'CONTENT_TYPE': 'image/jpeg',
+        'CONTENT_LENGTH': str(len(data)),
+        'wsgi.input': io.BytesIO(data),
+    })
+    bottle.request.user = SimpleNamespace(id=1, user_class=_User.Class.normal)
+    create_entry = importer.create_entry
+    context.claimed_during_upload = []
+
+    def create_entry_and_claim(*args, **kwargs):
+        # A worker polling right after the entry is created
+        entry = create_entry(*args, **kwargs)
+        context.claimed_during_upload.extend(
+            claim_import_ready_entries(context.upload.id, worker_id))
+        return entry
+
+    with mock.patch('images.importer.create_entry', create_entry_and_claim):
+        importer.upload('test', 'photo.jpg')
+
+
+@then('worker {worker_id} claimed nothing during the upload')
+def step_claimed_nothing(context, worker_id):
+    assert context.claimed_during_upload == [], context.claimed_during_upload
+
+
+@then('the upload is waiting for import')
+def step_upload_waiting(context):
+    with get_db().transaction() as t:
+        entry = t.query(_Entry).filter(
+            _Entry.import_location_id == context.upload.id).one()
+        assert entry.state == _Entry.State.import_ready, entry.state
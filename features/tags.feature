@@ -0,0 +1,21 @@
+Feature: Counting tags
+
+  Background:
+    Given a database
+      And an entry tagged holiday and beach
+      And an entry tagged holiday and city
+      And an entry tagged city
+
+  Scenario: Tags are counted over all entries
+     When the tag facets are counted
+     Then the facets are city 2, holiday 2 and beach 1
+
+  Scenario Outline: Tags are counted within a tag filter
+     When the tag facets are counted with <filter> <tags>
+     Then the facets are <facets>
+
+    Examples:
+      | filter       | tags          | facets                     |
+      | include_tags | holiday       | holiday 2, beach 1, city 1 |
+      | any_tags     | beach, city   | city 2, holiday 2, beach 1 |
+      | exclude_tags | beach         | city 2, holiday 1          |
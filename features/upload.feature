@@ -0,0 +1,8 @@
+Feature: Uploading files for import
+
+  Scenario: Uploads are only queued once their file is written
+    Given a database
+      And an upload location
+     When a photo is uploaded while worker A claims entries on the upload location
+     Then worker A claimed nothing during the upload
+      And the upload is waiting for import
@@ -43,12 +43,12 @@ if __name__ == '__main__':
     if not args.no_workers:
         logging.info("*** Setting up Workers...")
         managers = []
-        for module in (
-            scanner,
-            importer,
+        for module, section in (
+            (scanner, 'Scanner'),
+            (importer, 'Importer'),
         ):
             logging.info("Starting %s manager..." % (module.__name__))
-            managers.append(module.Manager())
+            managers.append(module.Manager(**setup.get_options(section)))
         logging.info("*** Done setting up Workers.")
 
     # Web-Apps
@@ -0,0 +1,43 @@
+"""A small in-process notification bus for waking up workers"""
+
+import logging
+from threading import Lock
+
+
+IMPORT = 'import'  # (location_id, count=None)
+SCAN = 'scan'  # (location_id)
+
+
+_subscribers = {}
+_lock = Lock()
+
+
+def subscribe(topic, callback):
+    """
+    Call `callback` with the arguments of every message published on `topic`.
+    """
+    with _lock:
+        _subscribers.setdefault(topic, []).append(callback)
+
+
+def unsubscribe(topic, callback):
+    with _lock:
+        try:
+            _subscribers.get(topic, []).remove(callback)
+        except ValueError:
+            pass
+
+
+def publish(topic, *args, **kwargs):
+    """
+    Deliver a message to all subscribers of `topic`, in the calling thread.
+    Subscribers are expected to return quickly, typically by setting an
+    Event. Publishing on a topic without subscribers does nothing.
+    """
+    with _lock:
+        callbacks = list(_subscribers.get(topic, []))
+    for callback in callbacks:
+        try:
+            callback(*args, **kwargs)
+        except Exception as e:
+            logging.error("Subscriber to %s failed %s", topic, str(e))
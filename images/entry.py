@@ -1,16 +1,27 @@
+import re
+import math
+import time
+import operator
+import base64
 import logging
 import bottle
 import datetime
 import urllib
 
-from sqlalchemy import Column, DateTime, String, Integer, Float, ForeignKey, func
-from sqlalchemy.orm import relationship
+from sqlalchemy import (
+    Column, DateTime, String, Integer, Float, Text, ForeignKey, Index,
+    func, and_, or_, case, exists, extract, select, text, table, column,
+)
+from sqlalchemy.orm import relationship, selectinload, aliased
+from sqlalchemy.exc import IntegrityError
 from samtt import get_db, Base
 from enum import IntEnum
+from threading import Lock
 
+from . import geohash
 from .file import File, _File
 from .metadata import register_metadata_schema, wrap_raw_json
-from .tag import Tag, _Tag, ensure_tag
+from .tag import _Tag, _EntryToTag, ensure_tag, ensure_tags, count_tags
 from .types import PropertySet, Property
 from .web import (
     Create,
@@ -23,6 +34,28 @@ from .user import authenticate, no_guests, current_user_id, current_is_user
 
 
 DELETE_AFTER = 24  # hours
+COUNT_CACHE_TIME = 60  # seconds
+COUNT_CACHE_SIZE = 1000  # users and filters
+CURSOR_TS_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+TIMELINE_GROUPS = ('year', 'month', 'day')
+FACET_LIMIT = 100  # tags
+SEARCH_TABLE = 'entry_search'
+SEARCH_FIELDS = ('title', 'creator', 'comment')
+SEARCH_PHYSICAL_FIELDS = ('Make', 'Model', 'Artist')
+BACKFILL_BATCH_SIZE = 500  # entries
+SORT_MISSING = {str: '', float: 0.0}  # sort value of entries without the property
+PROPERTY_FILTER = re.compile(r'^(\w+)(<=|>=|=|<|>)(.+)$')
+PROPERTY_OPERATORS = {
+    '=': operator.eq,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+KM_PER_DEGREE = 111.2  # of latitude
+# Geohash length of the clusters per web map zoom level, for a few
+# clusters per map tile
+CLUSTER_PRECISION = (1, 1, 2, 2, 2, 3, 3, 4, 4, 4, 5, 5, 6, 6, 6, 7, 7, 8, 8)
 
 
 # DB MODEL
@@ -31,6 +64,25 @@ DELETE_AFTER = 24  # hours
 
 class _Entry(Base):
     __tablename__ = 'entry'
+    __table_args__ = (
+        # get_entries orders and pages on (taken_ts, create_ts, id)
+        Index('entry_feed', 'taken_ts', 'create_ts', 'id'),
+        Index('entry_user_feed', 'user_id', 'taken_ts'),
+        Index('entry_access_feed', 'access', 'taken_ts'),
+        # claim_import_ready_entries seeks the top priority, the users
+        # waiting at it and their oldest entries on this one
+        Index('entry_import_claim', 'import_location_id', 'state', 'priority', 'user_id', 'id'),
+        # the lease reaper
+        Index('entry_lease', 'state', 'lease_ts'),
+        # import rates on the importer feed
+        Index('entry_imported', 'state', 'import_ts'),
+        # get_entry_by_source
+        Index('entry_source', 'source', 'original_filename'),
+        # bbox and radius filters range over latitude, clusters group on
+        # geohash prefixes
+        Index('entry_position', 'latitude', 'longitude'),
+        Index('entry_geohash', 'geohash'),
+    )
 
     class State(IntEnum):
         new = 0
@@ -47,6 +99,7 @@ class _Entry(Base):
         creator = Property()
         comment = Property()
         error = Property()
+        timings = Property(dict)  # import stage -> milliseconds
 
     class DefaultPhysicalMetadata(PropertySet):
         pass
@@ -63,6 +116,11 @@ class _Entry(Base):
         audio = 2
         other = 3
 
+    class Priority(IntEnum):
+        low = 0
+        normal = 1
+        high = 2
+
     id = Column(Integer, primary_key=True)
     original_filename = Column(String(256))
     source = Column(String(64))
@@ -71,17 +129,28 @@ class _Entry(Base):
     state = Column(Integer, nullable=False, default=State.new)
     delete_ts = Column(DateTime(timezone=True))
     access = Column(Integer, nullable=False, default=Access.private)
-    create_ts = Column(DateTime(timezone=True), default=func.now())
-    update_ts = Column(DateTime(timezone=True), default=func.now(),
-                       onupdate=func.now())
-    taken_ts = Column(DateTime(timezone=True), default=func.now())
+    # Set from Python rather than by the database, so that they are stored
+    # in the same format as the feed cursors compare them with
+    create_ts = Column(DateTime(timezone=True), default=datetime.datetime.utcnow)
+    update_ts = Column(DateTime(timezone=True), default=datetime.datetime.utcnow,
+                       onupdate=datetime.datetime.utcnow)
+    taken_ts = Column(DateTime(timezone=True), default=datetime.datetime.utcnow)
     latitude = Column(Float)
     longitude = Column(Float)
+    geohash = Column(String(geohash.PRECISION))
+    search_text = Column(Text)  # see make_search_text
+    worker_id = Column(String(128))
+    lease_ts = Column(DateTime(timezone=True))
+    attempts = Column(Integer, nullable=False, default=0)
+    retry_ts = Column(DateTime(timezone=True))
+    priority = Column(Integer, nullable=False, default=Priority.normal)
+    import_ts = Column(DateTime(timezone=True))  # when last brought online
 
     data = Column(String(32768))
     physical_data = Column(String(32768))
     files = relationship('_File')
     tags = relationship('_Tag', secondary='entry_to_tag')
+    properties = relationship('_EntryProperty', cascade='all, delete-orphan')
 
     user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
     user = relationship('_User')
@@ -89,6 +158,39 @@ class _Entry(Base):
     parent_entry = relationship('_Entry')
 
 
+class _EntryProperty(Base):
+    """
+    A physical metadata property promoted out of the JSON, so that entries
+    can be filtered and sorted on it, see promote_property.
+    """
+    __tablename__ = 'entry_property'
+    __table_args__ = (
+        Index('entry_property_unique', 'entry_id', 'name', unique=True),
+        Index('entry_property_text', 'name', 'text_value', 'entry_id'),
+        Index('entry_property_number', 'name', 'number_value', 'entry_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    entry_id = Column(Integer, ForeignKey('entry.id'), nullable=False)
+    name = Column(String(64), nullable=False)
+    text_value = Column(String(256))
+    number_value = Column(Float)
+
+
+promoted_properties = {}
+
+
+def promote_property(name, type=str):
+    """
+    Keep the physical metadata property `name` of entries in an indexed
+    column of `type`, str or float, for filtering and sorting. Entries
+    imported before need `backfill_entry_properties`.
+    """
+    if type not in (str, float):
+        raise ValueError("Promoted properties must be str or float")
+    promoted_properties[name] = type
+
+
 register_metadata_schema(_Entry.DefaultMetadata)
 register_metadata_schema(_Entry.DefaultPhysicalMetadata)
 
@@ -107,7 +209,19 @@ class App:
 
         app.route(
             path='/',
-            callback=FetchByQuery(get_entries),
+            callback=FetchByQuery(get_entries, EntryQuery),
+        )
+        app.route(
+            path='/timeline',
+            callback=FetchByQuery(get_timeline, TimelineQuery),
+        )
+        app.route(
+            path='/clusters',
+            callback=FetchByQuery(get_clusters, ClusterQuery),
+        )
+        app.route(
+            path='/tags',
+            callback=FetchByQuery(get_tag_facets, EntryQuery),
         )
         app.route(
             path='/<id:int>',
@@ -152,6 +266,8 @@ class Entry(PropertySet):
     source = Property()
     import_location_id = Property(int)
     state = Property(enum=_Entry.State)
+    priority = Property(enum=_Entry.Priority, default=_Entry.Priority.normal)
+    attempts = Property(int, default=0)
     delete_ts = Property()
     deleted = Property(bool, default=False)
     access = Property(enum=_Entry.Access, default=_Entry.Access.private)
@@ -184,6 +300,16 @@ class Entry(PropertySet):
         if hasattr(self.physical_metadata, 'Longitude'):
             return self.physical_metadata.Longitude
 
+    @property
+    def position(self):
+        """
+        The (latitude, longitude) of the entry as floats, or Nones. Older
+        metadata has them as text.
+        """
+        if self.latitude in (None, '') or self.longitude in (None, ''):
+            return None, None
+        return float(self.latitude), float(self.longitude)
+
     @property
     def tags_as_string(self):
         return ','.join(
@@ -208,11 +334,13 @@ class Entry(PropertySet):
         #         self.thumb_url = api.url().location.get_download_url(fd.location_id, fd.path)
 
     @classmethod
-    def map_in(self, entry):
+    def map_in(self, entry, locations=None):
         ed = Entry(
             id=entry.id,
             user_id=entry.user_id,
             state=_Entry.State(entry.state),
+            priority=_Entry.Priority(entry.priority),
+            attempts=entry.attempts,
             access=_Entry.Access(entry.access),
             original_filename=entry.original_filename,
             source=entry.source,
@@ -222,24 +350,32 @@ class Entry(PropertySet):
             taken_ts=entry.taken_ts.strftime('%Y-%m-%d %H:%M:%S') if entry.taken_ts else None,
             delete_ts=entry.delete_ts.strftime('%Y-%m-%d %H:%M:%S') if entry.delete_ts else None,
             deleted=entry.delete_ts is not None,
-            files=[File.map_in(f) for f in entry.files] if entry.files else [],
-            tags=sorted([Tag.map_in(t) for t in entry.tags]) if entry.tags else [],
+            files=[File.map_in(f, locations) for f in entry.files] if entry.files else [],
+            tags=sorted([t.id for t in entry.tags]) if entry.tags else [],
             metadata=wrap_raw_json(entry.data),
             physical_metadata=wrap_raw_json(entry.physical_data),
         )
         # ed.calculate_urls()
         return ed
 
-    def map_out(self, entry, system=False):
+    def map_out(self, entry, system=False, columns_only=False, t=None):
+        """
+        Copy onto the model `entry`. Its tags, properties and files are
+        written in the transaction `t` that `entry` belongs to, or in a
+        transaction of their own without one.
+        """
         entry.original_filename = self.original_filename
         entry.export_filename = self.export_filename
         entry.source = self.source
         entry.import_location_id = self.import_location_id
         entry.state = self.state
-        entry.taken_ts = (datetime.datetime.strptime(
-            self.taken_ts, '%Y-%m-%d %H:%M:%S').replace(microsecond=0)
-            if self.taken_ts else None
-        )
+        entry.priority = self.priority
+        if self.taken_ts:
+            entry.taken_ts = datetime.datetime.strptime(
+                self.taken_ts, '%Y-%m-%d %H:%M:%S').replace(microsecond=0)
+        elif entry.taken_ts is None:
+            # The feed is ordered on taken_ts, it must never be empty
+            entry.taken_ts = datetime.datetime.utcnow().replace(microsecond=0)
         if self.deleted and self.delete_ts is None:
             self.delete_ts = ((
                 datetime.datetime.utcnow() + datetime.timedelta(hours=DELETE_AFTER)
@@ -257,11 +393,30 @@ class Entry(PropertySet):
         )
         entry.user_id = self.user_id
         entry.parent_entry_id = self.parent_entry_id
-        entry.latitude = self.latitude
-        entry.longitude = self.longitude
-        with get_db().transaction() as t:
-            entry.tags = [t.query(_Tag).get(tag.id) for tag in self.tags]
-            entry.files = [t.query(_File).get(file.id) for file in self.files]
+        entry.latitude, entry.longitude = self.position
+        entry.search_text = make_search_text(
+            self.original_filename, self.metadata, self.physical_metadata)
+        entry.geohash = (
+            geohash.encode(entry.latitude, entry.longitude)
+            if entry.latitude is not None and entry.longitude is not None else None
+        )
+        if columns_only:
+            return
+        if t is None:
+            with get_db().transaction() as t:
+                self._map_out_links(entry, t)
+        else:
+            self._map_out_links(entry, t)
+
+    def _map_out_links(self, entry, t):
+        # entry_to_tag is unique on (tag_id, entry_id)
+        old_tags = set(tag.id for tag in entry.tags)
+        new_tags = set(tag for tag in self.tags if tag)
+        entry.tags = [t.query(_Tag).get(tag) for tag in sorted(new_tags)]
+        count_tags(t, new_tags - old_tags, 1)
+        count_tags(t, old_tags - new_tags, -1)
+        _set_properties(entry, promoted_values(self.physical_metadata))
+        entry.files = [t.query(_File).get(file.id) for file in self.files]
 
 
 class EntryFeed(PropertySet):
@@ -269,7 +424,6 @@ class EntryFeed(PropertySet):
     total_count = Property(int)
     prev_link = Property()
     next_link = Property()
-    offset = Property(int)
     entries = Property(list)
 
 
@@ -282,25 +436,33 @@ class EntryQuery(PropertySet):
     other = Property(bool, default=False)
     show_deleted = Property(bool, default=False)
     only_deleted = Property(bool, default=False)
-    include_tags = Property(list)
-    exclude_tags = Property(list)
+    include_tags = Property(list)  # all of these
+    any_tags = Property(list)  # at least one of these
+    exclude_tags = Property(list)  # none of these
     source = Property()
-
-    next_ts = Property(none='')
-    prev_offset = Property(int)
+    q = Property(none='')  # search
+    property_filters = Property(list)  # on promoted properties, like ISOSpeedRatings>=800
+    sort = Property(none='')  # promoted property to sort on before taken_ts
+    bbox = Property(none='')  # south,west,north,east
+    near = Property(none='')  # latitude,longitude
+    radius = Property(float, default=1.0)  # km from near
+
+    after = Property(none='')  # cursor
+    before = Property(none='')  # cursor
+    total = Property(bool, default=False)
     page_size = Property(int, default=25, required=True)
     order = Property(default='desc', required=True)
 
     @classmethod
-    def FromQuery(self):
-        eq = EntryQuery()
+    def FromRequest(self):
+        eq = self()
 
         eq.start_ts = bottle.request.query.start_ts
         eq.end_ts = bottle.request.query.end_ts
 
-        eq.next_ts = bottle.request.query.next_ts
-        if bottle.request.query.prev_offset not in (None, ''):
-            eq.prev_offset = bottle.request.query.prev_offset
+        eq.after = bottle.request.query.after
+        eq.before = bottle.request.query.before
+        eq.total = bottle.request.query.total == 'yes'
         if bottle.request.query.page_size not in (None, ''):
             eq.page_size = bottle.request.query.page_size
         if bottle.request.query.order not in (None, ''):
@@ -312,138 +474,613 @@ class EntryQuery(PropertySet):
         eq.other = bottle.request.query.other == 'yes'
 
         eq.source = bottle.request.query.source
+        eq.q = bottle.request.query.getunicode('q')
+        eq.sort = bottle.request.query.sort
+
+        eq.bbox = bottle.request.query.bbox
+        eq.near = bottle.request.query.near
+        if bottle.request.query.radius not in (None, ''):
+            eq.radius = bottle.request.query.radius
 
         eq.show_deleted = bottle.request.query.show_deleted == 'yes'
         eq.only_deleted = bottle.request.query.only_deleted == 'yes'
 
         decoded = bottle.request.query.decode()
         eq.include_tags = decoded.getall('include_tags')
+        eq.any_tags = decoded.getall('any_tags')
         eq.exclude_tags = decoded.getall('exclude_tags')
+        eq.property_filters = decoded.getall('property')
         return eq
 
-    def to_query_string(self):
+    def to_query_string(self, paging=True):
         return urllib.parse.urlencode(
             (
                 ('start_ts', self.start_ts),
                 ('end_ts', self.end_ts),
-                ('next_ts', self.next_ts),
-                ('prev_offset', self.prev_offset or ''),
-                ('page_size', self.page_size),
-                ('order', self.order),
                 ('image', 'yes' if self.image else 'no'),
                 ('video', 'yes' if self.video else 'no'),
                 ('audio', 'yes' if self.audio else 'no'),
                 ('other', 'yes' if self.other else 'no'),
-                ('source', self.source),
+                ('source', self.source or ''),
+                ('q', self.q),
+                ('bbox', self.bbox),
+                ('near', self.near),
+                ('radius', self.radius),
                 ('show_deleted', 'yes' if self.show_deleted else 'no'),
                 ('only_deleted', 'yes' if self.only_deleted else 'no'),
             ) +
             tuple([
                 ('include_tags', tag) for tag in self.include_tags
             ]) +
+            tuple([
+                ('any_tags', tag) for tag in self.any_tags
+            ]) +
             tuple([
                 ('exclude_tags', tag) for tag in self.exclude_tags
-            ])
+            ]) +
+            tuple([
+                ('property', expression) for expression in self.property_filters
+            ]) +
+            ((
+                ('after', self.after),
+                ('before', self.before),
+                ('total', 'yes' if self.total else 'no'),
+                ('sort', self.sort),
+                ('page_size', self.page_size),
+                ('order', self.order),
+            ) if paging else ())
         )
 
 
+class TimelineQuery(EntryQuery):
+    group = Property(default='month', required=True)  # year, month or day
+
+    @classmethod
+    def FromRequest(self):
+        tq = super().FromRequest()
+        if bottle.request.query.group not in (None, ''):
+            tq.group = bottle.request.query.group
+        return tq
+
+
+class TimelineBucket(PropertySet):
+    date = Property()
+    year = Property(int)
+    month = Property(int)
+    day = Property(int)
+    count = Property(int)
+
+
+class TimelineFeed(PropertySet):
+    group = Property()
+    count = Property(int)
+    entries = Property(list)
+
+
+class ClusterQuery(EntryQuery):
+    zoom = Property(int, default=0, required=True)  # web map zoom level
+
+    @classmethod
+    def FromRequest(self):
+        cq = super().FromRequest()
+        if bottle.request.query.zoom not in (None, ''):
+            cq.zoom = bottle.request.query.zoom
+        return cq
+
+
+class Cluster(PropertySet):
+    geohash = Property()
+    latitude = Property(float)
+    longitude = Property(float)
+    count = Property(int)
+
+
+class ClusterFeed(PropertySet):
+    zoom = Property(int)
+    count = Property(int)
+    entries = Property(list)
+
+
+class TagFacet(PropertySet):
+    id = Property()
+    count = Property(int)
+
+
+class TagFacetFeed(PropertySet):
+    count = Property(int)
+    entries = Property(list)
+
+
 #####
 # API
 
 
 def get_entries(query=None, system=False):
+    """
+    Get the entries matching `query`, newest first by default.
+
+    Entries are paged with a keyset over (taken_ts, create_ts, id): the
+    `after` and `before` cursors of the query point at the entry to page
+    from, so a page deep into the feed costs the same as the first one.
+    The feed links to the neighbouring pages with fresh cursors. Without a
+    query, all matching entries are returned.
+
+    With `sort`, entries are ordered on that promoted property first, and
+    entries without it come last, in the order of the plain feed.
+
+    The total count is only given when asked for with `total`, and is then
+    cached for COUNT_CACHE_TIME seconds per user and filter.
+    """
     with get_db().transaction() as t:
-        q = (
-            t.query(_Entry).order_by(_Entry.taken_ts.desc(), _Entry.create_ts.desc())
+        q = _filter_entries(t.query(_Entry), query, system)
+        # Load the files, their locations and the tags of a whole page in
+        # a few queries instead of a few per entry
+        q = q.options(
+            selectinload(_Entry.files).joinedload(_File.location),
+            selectinload(_Entry.tags),
         )
-        if not system:
-            q = q.filter(
-                (_Entry.user_id == current_user_id()) | (_Entry.access >= _Entry.Access.users)
+        descending = query is None or query.order != 'asc'
+        # (key, descending) pairs
+        keys = [
+            (_Entry.taken_ts, descending),
+            (_Entry.create_ts, descending),
+            (_Entry.id, descending),
+        ]
+
+        sort = query.sort if query is not None else None
+        if sort:
+            if sort not in promoted_properties:
+                raise bottle.HTTPError(400, "Can not sort on %s" % sort)
+            sorted_by = aliased(_EntryProperty)
+            q = q.outerjoin(sorted_by, and_(
+                sorted_by.entry_id == _Entry.id, sorted_by.name == sort))
+            q = q.options(selectinload(_Entry.properties))
+            value = _property_column(sorted_by, sort)
+            # Entries with the property first whatever the order, so that
+            # the keyset never has to compare with NULL
+            keys = [
+                (case([(value.isnot(None), 1)], else_=0), True),
+                (func.coalesce(value, SORT_MISSING[promoted_properties[sort]]), descending),
+            ] + keys
+
+        if query is None:
+            entries = q.order_by(*[key.desc() for key, _ in keys]).all()
+            return EntryFeed(
+                count=len(entries),
+                total_count=len(entries),
+                entries=[Entry.map_in(entry, {}) for entry in entries],
             )
 
-            if not current_is_user():
-                q = q.filter(_Entry.access >= _Entry.Access.public)
-
-        if query is not None:
-            logging.info("Query: %s", query.to_json())
+        logging.info("Query: %s", query.to_json())
+        backwards = bool(query.before) and not query.after
+        if backwards:
+            keys = [(key, not desc) for key, desc in keys]
+        cursor = decode_cursor(query.before if backwards else query.after, sort)
+        if cursor is not None:
+            q = q.filter(_keyset(keys, cursor))
+
+        # Fetch one extra entry to know if there is another page
+        page_size = query.page_size
+        q = q.order_by(*[key.desc() if desc else key.asc() for key, desc in keys])
+        entries = q.limit(page_size + 1).all()
+        more = len(entries) > page_size
+        entries = entries[:page_size]
+        if backwards:
+            entries.reverse()
+
+        locations = {}
+        result = EntryFeed(
+            count=len(entries),
+            entries=[Entry.map_in(entry, locations) for entry in entries],
+        )
 
-            if query.start_ts:
-                start_ts = (datetime.datetime.strptime(
-                    query.start_ts, '%Y-%m-%d')
-                    .replace(hour=0, minute=0, second=0, microsecond=0))
-                q = q.filter(_Entry.taken_ts >= start_ts)
+        if query.total:
+            result.total_count = _count_entries(t, query, system)
 
-            if query.end_ts:
-                end_ts = (datetime.datetime.strptime(
-                    query.end_ts, '%Y-%m-%d')
-                    .replace(hour=0, minute=0, second=0, microsecond=0))
-                q = q.filter(_Entry.taken_ts < end_ts)
+        # Paging
+        if entries:
+            if more or backwards:
+                result.next_link = _page_link(query, after=encode_cursor(entries[-1], sort))
+            if (more and backwards) or (cursor is not None and not backwards):
+                result.prev_link = _page_link(query, before=encode_cursor(entries[0], sort))
 
-            types = [t.value for t in _Entry.Type if getattr(query, t.name)]
-            if types:
-                q = q.filter(_Entry.type.in_(types))
+        return result
 
-            if not query.show_deleted:
-                q = q.filter(_Entry.delete_ts.is_(None))
-            if query.only_deleted:
-                q = q.filter(_Entry.delete_ts.isnot(None))
 
-            for tag in query.include_tags:
-                q = q.filter(_Entry.tags.like('%~' + tag + '~%'))
-            for tag in query.exclude_tags:
-                q = q.filter(~_Entry.tags.like('%~' + tag + '~%'))
+def get_timeline(query, system=False):
+    """
+    Count the entries matching the filters of `query` per year, month or
+    day of taken_ts, so that clients can build a date navigator and jump
+    into the feed with start_ts/end_ts.
+    """
+    if query.group not in TIMELINE_GROUPS:
+        raise bottle.HTTPError(400, "group must be one of %s" % ', '.join(TIMELINE_GROUPS))
 
-            if query.source:
-                q = q.filter(_Entry.source == query.source)
+    parts = TIMELINE_GROUPS[:TIMELINE_GROUPS.index(query.group) + 1]
+    keys = [extract(part, _Entry.taken_ts).label(part) for part in parts]
+    order = [key.desc() if query.order != 'asc' else key.asc() for key in keys]
 
-        total_count = q.count()
+    with get_db().transaction() as t:
+        q = t.query(*(keys + [func.count(_Entry.id)]))
+        q = _filter_entries(q, query, system)
+        rows = q.group_by(*keys).order_by(*order).all()
+
+        buckets = []
+        for row in rows:
+            values = dict(zip(parts, (int(value) for value in row[:-1])))
+            buckets.append(TimelineBucket(
+                date='-'.join('%02i' % values[part] for part in parts),
+                count=row[-1],
+                **values
+            ))
+
+        return TimelineFeed(
+            group=query.group,
+            count=len(buckets),
+            entries=buckets,
+        )
 
-        # Default values for when no paging occurs
-        offset = 0
-        total_count_paged = total_count
 
-        # Paging
-        if query is not None:
-            if query.next_ts:
-                end_ts = (datetime.datetime.strptime(
-                    query.next_ts, '%Y-%m-%d %H:%M:%S').replace(microsecond=0))
-                q = q.filter(_Entry.taken_ts < end_ts)
-                total_count_paged = q.count()
-                offset = total_count - total_count_paged
-
-            elif query.prev_offset:
-                q = q.offset(query.prev_offset)
-                total_count_paged = total_count
-                offset = query.prev_offset
-
-            logging.info(q)
-            page_size = query.page_size
-            entries = q.limit(page_size).all()
+def get_tag_facets(query, system=False):
+    """
+    Count the entries matching `query` per tag, most used tags first, for
+    filtering on tags within the current feed. The counts of all entries
+    are maintained on the tags themselves, see `get_tags`.
+    """
+    count = func.count(_EntryToTag.entry_id)
+    with get_db().transaction() as t:
+        q = t.query(_EntryToTag.tag_id, count).join(
+            _Entry, _Entry.id == _EntryToTag.entry_id)
+        q = _filter_entries(q, query, system)
+        rows = (
+            q.group_by(_EntryToTag.tag_id)
+            .order_by(count.desc(), _EntryToTag.tag_id)
+            .limit(FACET_LIMIT)
+            .all()
+        )
 
-        else:
-            entries = q.all()
+        return TagFacetFeed(
+            count=len(rows),
+            entries=[TagFacet(id=tag_id, count=n) for tag_id, n in rows],
+        )
 
-        count = len(entries)
 
-        result = EntryFeed(
-            count=count,
-            total_count=total_count,
-            offset=offset,
-            entries=[Entry.map_in(entry) for entry in entries],
+def get_clusters(query, system=False):
+    """
+    Count the geotagged entries matching `query` per geohash cell, with the
+    cells sized for the map zoom level of the query, and place each
+    cluster at the mean position of its entries.
+    """
+    zoom = max(0, min(query.zoom, len(CLUSTER_PRECISION) - 1))
+    cell = func.substr(_Entry.geohash, 1, CLUSTER_PRECISION[zoom]).label('cell')
+    with get_db().transaction() as t:
+        q = t.query(
+            cell,
+            func.avg(_Entry.latitude),
+            func.avg(_Entry.longitude),
+            func.count(_Entry.id),
+        ).filter(_Entry.geohash.isnot(None))
+        q = _filter_entries(q, query, system)
+        rows = q.group_by(cell).all()
+
+        return ClusterFeed(
+            zoom=zoom,
+            count=len(rows),
+            entries=[
+                Cluster(geohash=c, latitude=lat, longitude=lon, count=n)
+                for c, lat, lon, n in rows
+            ],
         )
 
-        # Paging
-        if query is not None:
-            if total_count > count:
-                query.next_ts = result.entries[-1].taken_ts
-                result.next_link = App.BASE + '?' + query.to_query_string()
 
-            if count > 0 and offset > 0:
-                query.next_ts = ''
-                query.prev_offset = max(offset - page_size, 0)
-                result.prev_link = App.BASE + '?' + query.to_query_string()
+def _filter_entries(q, query, system):
+    """
+    Apply access control and the filters of `query` to an _Entry query.
+    """
+    if not system:
+        q = q.filter(
+            (_Entry.user_id == current_user_id()) | (_Entry.access >= _Entry.Access.users)
+        )
 
-        return result
+        if not current_is_user():
+            q = q.filter(_Entry.access >= _Entry.Access.public)
+
+    if query is None:
+        return q
+
+    if query.start_ts:
+        start_ts = (datetime.datetime.strptime(
+            query.start_ts, '%Y-%m-%d')
+            .replace(hour=0, minute=0, second=0, microsecond=0))
+        q = q.filter(_Entry.taken_ts >= start_ts)
+
+    if query.end_ts:
+        end_ts = (datetime.datetime.strptime(
+            query.end_ts, '%Y-%m-%d')
+            .replace(hour=0, minute=0, second=0, microsecond=0))
+        q = q.filter(_Entry.taken_ts < end_ts)
+
+    types = [t.value for t in _Entry.Type if getattr(query, t.name)]
+    if types:
+        q = q.filter(_Entry.type.in_(types))
+
+    if not query.show_deleted:
+        q = q.filter(_Entry.delete_ts.is_(None))
+    if query.only_deleted:
+        q = q.filter(_Entry.delete_ts.isnot(None))
+
+    for tag in set(query.include_tags):
+        q = q.filter(_has_tags([tag]))
+    if query.any_tags:
+        q = q.filter(_has_tags(query.any_tags))
+    if query.exclude_tags:
+        q = q.filter(~_has_tags(query.exclude_tags))
+
+    if query.source:
+        q = q.filter(_Entry.source == query.source)
+
+    if query.q:
+        q = q.filter(_search(q.session, query.q))
+
+    for expression in query.property_filters:
+        q = q.filter(_has_property(expression))
+
+    if query.bbox:
+        south, west, north, east = _parse_floats(query.bbox, 4, 'bbox')
+        q = q.filter(_Entry.latitude.between(south, north))
+        if west <= east:
+            q = q.filter(_Entry.longitude.between(west, east))
+        else:  # across the antimeridian
+            q = q.filter((_Entry.longitude >= west) | (_Entry.longitude <= east))
+
+    if query.near:
+        latitude, longitude = _parse_floats(query.near, 2, 'near')
+        # Range over the index first, then compare squared distances on an
+        # equirectangular projection, which is exact enough at photo scale
+        # and needs no trigonometry in the database
+        dlat = query.radius / KM_PER_DEGREE
+        scale = max(math.cos(math.radians(latitude)), 0.01)
+        dlon = dlat / scale
+        q = q.filter(
+            _Entry.latitude.between(latitude - dlat, latitude + dlat),
+            _Entry.longitude.between(longitude - dlon, longitude + dlon),
+            (
+                (_Entry.latitude - latitude) * (_Entry.latitude - latitude) +
+                (_Entry.longitude - longitude) * (_Entry.longitude - longitude) * scale * scale
+            ) <= dlat * dlat,
+        )
+
+    return q
+
+
+def _parse_floats(value, count, name):
+    try:
+        values = [float(v) for v in value.split(',')]
+    except ValueError:
+        values = []
+    if len(values) != count:
+        raise bottle.HTTPError(400, "%s must be %i comma separated numbers" % (name, count))
+    return values
+
+
+def make_search_text(original_filename, metadata, physical_metadata):
+    """
+    The text that the entry is found by when searching, kept in a column
+    so that searching never has to read the JSON metadata.
+    """
+    words = [original_filename]
+    words.extend(getattr(metadata, name, None) for name in SEARCH_FIELDS)
+    words.extend(getattr(physical_metadata, name, None) for name in SEARCH_PHYSICAL_FIELDS)
+    return ' '.join(str(word) for word in words if word).lower()
+
+
+_search_index = None
+
+
+def has_search_index(t):
+    """
+    Whether the FTS5 search index has been set up, see images.migrate.
+    """
+    global _search_index
+    if _search_index is None:
+        _search_index = (
+            t.get_bind().dialect.name == 'sqlite' and
+            t.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type='table' AND name=:name"),
+                {'name': SEARCH_TABLE},
+            ).first() is not None
+        )
+    return _search_index
+
+
+def _search(t, q):
+    """
+    A filter for the entries whose search text has all the words of `q`,
+    as word prefixes with the search index, or anywhere without one.
+    """
+    words = q.lower().split()
+    if not has_search_index(t):
+        return and_(*[_Entry.search_text.contains(word, autoescape=True) for word in words])
+
+    match = ' '.join('"%s"*' % word.replace('"', '""') for word in words)
+    search = table(SEARCH_TABLE, column('rowid'))
+    return _Entry.id.in_(
+        select([search.c.rowid]).where(column(SEARCH_TABLE).op('MATCH')(match))
+    )
+
+
+def promoted_values(physical_metadata):
+    """
+    The promoted properties of `physical_metadata` as a dict of name to
+    (text_value, number_value), leaving out missing and unusable values.
+    """
+    values = {}
+    for name, type in promoted_properties.items():
+        value = _promoted_value(type, getattr(physical_metadata, name, None))
+        if value is not None:
+            values[name] = (value, None) if type is str else (None, value)
+    return values
+
+
+def _promoted_value(type, value):
+    if value is None or value == '':
+        return None
+    try:
+        if type is float and isinstance(value, (list, tuple)):  # ratio
+            num, den = value
+            return float(num) / den if den else None
+        return type(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _set_properties(entry, values):
+    existing = {p.name: p for p in entry.properties}
+    for name, p in existing.items():
+        if name not in values:
+            entry.properties.remove(p)
+    for name, (text_value, number_value) in values.items():
+        p = existing.get(name)
+        if p is None:
+            p = _EntryProperty(name=name)
+            entry.properties.append(p)
+        p.text_value = text_value
+        p.number_value = number_value
+
+
+def _property_column(entity, name):
+    if promoted_properties[name] is float:
+        return entity.number_value
+    return entity.text_value
+
+
+def _has_property(expression):
+    """
+    A semi-join on entry_property for an expression like Model=X100F or
+    ISOSpeedRatings>=800, answered from the (name, value) indexes.
+    """
+    match = PROPERTY_FILTER.match(expression)
+    if match is None or match.group(1) not in promoted_properties:
+        raise bottle.HTTPError(400, "Bad property filter %s" % expression)
+    name, op, value = match.groups()
+    value = _promoted_value(promoted_properties[name], value)
+    if value is None:
+        raise bottle.HTTPError(400, "Bad property filter %s" % expression)
+    return exists().where(and_(
+        _EntryProperty.entry_id == _Entry.id,
+        _EntryProperty.name == name,
+        PROPERTY_OPERATORS[op](_property_column(_EntryProperty, name), value),
+    ))
+
+
+def _has_tags(tags):
+    """
+    A semi-join on entry_to_tag for the entries with any of `tags`, which
+    is answered from the (tag_id, entry_id) index. Only correlated on
+    entry, as the tag facets have entry_to_tag in the outer query too.
+    """
+    tags = list(set(tags))
+    return exists().where(and_(
+        _EntryToTag.entry_id == _Entry.id,
+        _EntryToTag.tag_id == tags[0] if len(tags) == 1 else _EntryToTag.tag_id.in_(tags),
+    )).correlate(_Entry)
+
+
+def _keyset(keys, values):
+    """
+    A filter for the rows that come after `values` when ordering on `keys`,
+    given as (key, descending) pairs.
+    """
+    clauses = []
+    for n, ((key, descending), value) in enumerate(zip(keys, values)):
+        clauses.append(and_(*(
+            [k == v for (k, _), v in zip(keys[:n], values[:n])] +
+            [key < value if descending else key > value]
+        )))
+    return or_(*clauses)
+
+
+def encode_cursor(entry, sort=None):
+    """
+    An opaque token for paging from `entry`, in a feed sorted on the
+    promoted property `sort` if given.
+    """
+    parts = [
+        entry.taken_ts.strftime(CURSOR_TS_FORMAT),
+        entry.create_ts.strftime(CURSOR_TS_FORMAT),
+        str(entry.id),
+    ]
+    if sort:
+        value = next((
+            _property_column(p, sort) for p in entry.properties if p.name == sort
+        ), None)
+        if value is None:
+            parts.append('')
+        else:
+            parts.append('=' + (repr(value) if promoted_properties[sort] is float else value))
+    raw = '|'.join(parts)
+    return base64.urlsafe_b64encode(raw.encode('utf8')).decode('ascii')
+
+
+def decode_cursor(token, sort=None):
+    if not token:
+        return None
+    try:
+        parts = base64.urlsafe_b64decode(token.encode('ascii')).decode('utf8').split('|', 3)
+        if len(parts) != (4 if sort else 3):
+            raise ValueError("Cursor does not match the sort order")
+        cursor = (
+            datetime.datetime.strptime(parts[0], CURSOR_TS_FORMAT),
+            datetime.datetime.strptime(parts[1], CURSOR_TS_FORMAT),
+            int(parts[2]),
+        )
+        if sort:
+            type = promoted_properties[sort]
+            if parts[3]:
+                cursor = (1, type(parts[3][1:])) + cursor
+            else:
+                cursor = (0, SORT_MISSING[type]) + cursor
+        return cursor
+    except (ValueError, UnicodeError):
+        raise bottle.HTTPError(400, "Bad cursor")
+
+
+def _page_link(query, after='', before=''):
+    query.after = after
+    query.before = before
+    return App.BASE + '?' + query.to_query_string()
+
+
+_count_cache = {}
+_count_cache_lock = Lock()
+
+
+def _count_entries(t, query, system):
+    key = (None if system else current_user_id(), query.to_query_string(paging=False))
+    now = time.monotonic()
+    with _count_cache_lock:
+        cached = _count_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    count = _filter_entries(t.query(func.count(_Entry.id)), query, system).scalar()
+    with _count_cache_lock:
+        if key not in _count_cache and len(_count_cache) >= COUNT_CACHE_SIZE:
+            _evict_counts(now)
+        _count_cache[key] = (now + COUNT_CACHE_TIME, count)
+    return count
+
+
+def _evict_counts(now):
+    """
+    Make room in the full count cache, dropping the expired counts, or
+    else the oldest tenth of them.
+    """
+    expired = [key for key, (expires, _) in _count_cache.items() if expires <= now]
+    if not expired:
+        by_age = sorted(_count_cache, key=lambda key: _count_cache[key][0])
+        expired = by_age[:max(COUNT_CACHE_SIZE // 10, 1)]
+    for key in expired:
+        del _count_cache[key]
 
 
 def get_entry_by_id(id):
@@ -474,7 +1111,7 @@ def update_entry_by_id(id, ed, system=False):
                 (_Entry.user_id == current_user_id()) | (_Entry.access >= _Entry.Access.common)
             )
         entry = q.one()
-        ed.map_out(entry)
+        ed.map_out(entry, t=t)
 
     return get_entry_by_id(id)
 
@@ -486,7 +1123,7 @@ def create_entry(ed, system=False):
         for tag in ed.tags:
             ensure_tag(tag)
 
-        ed.map_out(entry, system=system)
+        ed.map_out(entry, system=system, t=t)
         t.add(entry)
         t.commit()
         id = entry.id
@@ -494,6 +1131,122 @@ def create_entry(ed, system=False):
     return get_entry_by_id(id)
 
 
+def create_entries(eds):
+    """
+    Create many entries, with their files and tag links, in one
+    transaction. The files of the entries are created too and must not
+    have ids yet. Missing tags are created.
+
+    Entries are inserted one statement each, to get their ids, files and
+    tag links with one executemany each. Raises _File.ConflictException,
+    creating nothing, if any of the files is already managed.
+
+    Returns the ids of the new entries.
+    """
+    ensure_tags(set(tag for ed in eds for tag in ed.tags if tag))
+
+    ids = []
+    files = []
+    links = []
+    properties = []
+    try:
+        with get_db().transaction() as t:
+            for ed in eds:
+                entry = _Entry()
+                ed.map_out(entry, system=True, columns_only=True)
+                id = t.execute(
+                    _Entry.__table__.insert(), _column_values(entry)
+                ).inserted_primary_key[0]
+                ids.append(id)
+
+                for fd in ed.files:
+                    f = _File()
+                    fd.map_out(f)
+                    f.entry_id = id
+                    files.append(_column_values(f))
+                for tag in set(ed.tags):
+                    if tag:
+                        links.append({'entry_id': id, 'tag_id': tag})
+                for name, (text_value, number_value) in promoted_values(
+                        ed.physical_metadata).items():
+                    properties.append({
+                        'entry_id': id,
+                        'name': name,
+                        'text_value': text_value,
+                        'number_value': number_value,
+                    })
+
+            if files:
+                t.execute(_File.__table__.insert(), files)
+            if links:
+                t.execute(_EntryToTag.__table__.insert(), links)
+                count_tags(t, [link['tag_id'] for link in links], 1)
+            if properties:
+                t.execute(_EntryProperty.__table__.insert(), properties)
+    except IntegrityError as e:
+        if _is_unique_violation(e):
+            raise _File.ConflictException()
+        raise
+
+    return ids
+
+
+def backfill_entry_properties(batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Rewrite the promoted properties of all entries from their physical
+    metadata, for entries imported before a property was promoted.
+    Returns the number of entries that have properties.
+    """
+    last_id = 0
+    count = 0
+    while True:
+        with get_db().transaction() as t:
+            entries = (
+                t.query(_Entry)
+                .filter(_Entry.id > last_id, _Entry.physical_data.isnot(None))
+                .options(selectinload(_Entry.properties))
+                .order_by(_Entry.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not entries:
+                break
+            for entry in entries:
+                try:
+                    physical_metadata = wrap_raw_json(entry.physical_data)
+                except (ValueError, NameError):
+                    physical_metadata = None
+                values = promoted_values(physical_metadata)
+                _set_properties(entry, values)
+                if values:
+                    count += 1
+            last_id = entries[-1].id
+        logging.info("Backfilled properties up to entry %i", last_id)
+    return count
+
+
+def _is_unique_violation(e):
+    """
+    Tell a unique constraint failure, like a file path that is already
+    managed, from other integrity errors, like a missing user_id.
+    """
+    if getattr(e.orig, 'pgcode', None) == '23505':
+        return True
+    return 'unique' in str(e.orig).lower()
+
+
+def _column_values(instance):
+    """
+    The column values set on an unsaved model instance, leaving out unset
+    ones so that column defaults apply.
+    """
+    return {
+        column.key: getattr(instance, column.key)
+        for column in instance.__table__.columns
+        if getattr(instance, column.key) is not None
+    }
+
+
 def delete_entry_by_id(id, system=False):
     with get_db().transaction() as t:
         q = t.query(_Entry).filter(_Entry.id == id)
@@ -501,4 +1254,9 @@ def delete_entry_by_id(id, system=False):
             q = q.filter(
                 (_Entry.user_id == current_user_id()) | (_Entry.access >= _Entry.Access.common)
             )
-        q.delete()
+        entry = q.one_or_none()
+        if entry is None:
+            return
+        # Deleting through the session removes the tag links as well
+        count_tags(t, [tag.id for tag in entry.tags], -1)
+        t.delete(entry)
@@ -26,7 +26,7 @@ def exif_position(exif):
 
     if exif.get('GPS GPSLatitudeRef').printable == 'S':
         lat *= -1
-    if exif.get('GPS GPSLongitudeRef').printable == 'S':
+    if exif.get('GPS GPSLongitudeRef').printable == 'W':
         lon *= -1
 
     return lat, lon
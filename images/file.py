@@ -1,7 +1,9 @@
 import os
+import math
+import hashlib
 
 from enum import IntEnum
-from sqlalchemy import Column, String, Integer, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, String, Integer, ForeignKey, UniqueConstraint, Index, func
 from sqlalchemy.orm import relationship
 from sqlalchemy.exc import IntegrityError
 from samtt import Base, get_db
@@ -10,6 +12,10 @@ from .location import Location
 from .types import PropertySet, Property
 
 
+BLOOM_THRESHOLD = 1000000  # files on a location
+BLOOM_ERROR_RATE = 0.01
+
+
 # DB MODEL
 ##########
 
@@ -18,6 +24,7 @@ class _File(Base):
     __tablename__ = 'file'
     __table_args__ = (
         UniqueConstraint('location_id', 'path', name='path_constraint'),
+        Index('file_entry', 'entry_id'),
     )
 
     class Purpose(IntEnum):
@@ -59,11 +66,24 @@ class File(PropertySet):
         return os.path.join(self.location.root, self.path)
 
     @classmethod
-    def map_in(self, file):
+    def map_in(self, file, locations=None):
+        """
+        Map in a file. Pass a dict as `locations` to share the mapped
+        locations between files, keyed on location id.
+        """
+        if file.location is None:
+            location = None
+        elif locations is None:
+            location = Location.map_in(file.location)
+        else:
+            location = locations.get(file.location_id)
+            if location is None:
+                location = locations[file.location_id] = Location.map_in(file.location)
+
         f = File(
             id=file.id,
             path=file.path,
-            location=Location.map_in(file.location) if file.location else None,
+            location=location,
             entry_id=file.entry_id,
             filesize=file.filesize,
             purpose=_File.Purpose(file.purpose),
@@ -120,3 +140,95 @@ def update_file_by_id(id, f):
 def delete_file_by_id(id):
     with get_db().transaction() as t:
         t.query(_File).filter(_File.id == id).delete()
+
+
+def get_managed_paths(location_id, paths):
+    """
+    Return the subset of `paths` that are already files on a location.
+    """
+    if not paths:
+        return set()
+    with get_db().transaction() as t:
+        return set(
+            row.path for row in t.query(_File.path).filter(
+                _File.location_id == location_id,
+                _File.path.in_(list(paths)),
+            )
+        )
+
+
+class KnownPaths(object):
+    """
+    The paths of all files on a location, loaded once, for telling new
+    files from managed ones without a database round trip per file. They
+    are loaded when first asked about a path, so a scan that finds no
+    files costs the database nothing.
+
+    Locations with more than BLOOM_THRESHOLD files are kept in a Bloom
+    filter instead of a set. Paths the filter may know are confirmed
+    against the database, so no new file is ever taken for a managed one.
+    """
+    def __init__(self, location_id):
+        self.location_id = location_id
+        self.paths = None
+
+    def load(self):
+        with get_db().transaction() as t:
+            count = t.query(func.count(_File.id)).filter(
+                _File.location_id == self.location_id
+            ).scalar()
+            if count > BLOOM_THRESHOLD:
+                self.paths = BloomFilter(count * 2, BLOOM_ERROR_RATE)
+            else:
+                self.paths = set()
+            for row in t.query(_File.path).filter(
+                    _File.location_id == self.location_id).yield_per(10000):
+                self.paths.add(row.path)
+
+    def add(self, path):
+        # Not loaded yet, the database will have it
+        if self.paths is not None:
+            self.paths.add(path)
+
+    def filter_new(self, paths):
+        """
+        Return the paths in `paths` that are not files on the location.
+        """
+        if not paths:
+            return []
+        if self.paths is None:
+            self.load()
+        maybe = [p for p in paths if p in self.paths]
+        if maybe and isinstance(self.paths, BloomFilter):
+            managed = get_managed_paths(self.location_id, maybe)
+        else:
+            managed = set(maybe)
+        return [p for p in paths if p not in managed]
+
+
+class BloomFilter(object):
+    """
+    A set-like filter of strings that answers "maybe" or "no", in about
+    ten bits per item for a 1% error rate.
+    """
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        ln2 = math.log(2)
+        self.size = max(int(-capacity * math.log(error_rate) / (ln2 * ln2)), 8)
+        self.hashes = max(int(round(self.size / capacity * ln2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
@@ -0,0 +1,36 @@
+"""Geohash encoding, for grouping and indexing entry positions by cell"""
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+PRECISION = 9  # characters, cells of about 5 x 5 meters
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    """
+    The geohash of the cell of `precision` characters containing the
+    position. Positions sharing a prefix lie in the same, larger, cell.
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    n = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            value, interval = longitude, lon_range
+        else:
+            value, interval = latitude, lat_range
+        middle = (interval[0] + interval[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        n += 1
+        if n == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            n = 0
+    return ''.join(chars)
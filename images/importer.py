@@ -5,21 +5,43 @@ import mimetypes
 import os
 import re
 import base64
+import socket
+import time
+import errno
+import datetime
 import bottle
 
-from sqlalchemy.orm.exc import NoResultFound
+from collections import deque
+from contextlib import contextmanager
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
 from samtt import get_db
-from threading import Thread, Event
+from threading import Thread, Event, Lock, current_thread
 
-from .file import File, _File, create_file
-from .entry import Entry, _Entry, create_entry, update_entry_by_id
-from .location import Location, get_locations_by_type, get_location_by_type, IMPORTABLE
+from . import bus
+from .file import File, _File, create_file, update_file_by_id
+from .entry import Entry, _Entry, create_entry
+from .location import get_locations_by_type, get_location_by_type, IMPORTABLE
 from .metadata import wrap_raw_json
 from .user import authenticate, require_admin, no_guests, get_current_user
 
 
 re_clean = re.compile(r'[^A-Za-z0-9_\-\.]')
 
+LEASE_TIME = 600  # seconds
+LEASE_RENEWALS = 4  # per lease time, while importing
+MAX_ATTEMPTS = 3
+REAP_INTERVAL = 60  # seconds
+IDLE_WAKEUP = 30  # seconds, 0 to only wake up on notifications
+# Standalone workers get no notifications from the web app, so they poll
+# often enough for uploads to be picked up within seconds. An idle poll is
+# one indexed claim query.
+WORKER_IDLE_WAKEUP = 5  # seconds
+RETRY_DELAY = 30  # seconds, doubled for each attempt
+MAX_RETRY_DELAY = 3600  # seconds
+STATS_WINDOW = 500  # imports per location
+RATE_WINDOWS = (1, 5, 15)  # minutes
+
 
 # WEB
 #####
@@ -52,18 +74,36 @@ class App:
             method='POST',
             callback=lambda id: reset_entry(id),
         )
+        app.route(
+            path='/retry/<id:int>',
+            method='POST',
+            callback=lambda id: retry_location(id),
+        )
 
         return app
 
 
 def get_importers_dict():
     no_guests()
+    queues = get_queue_depths()
+    workers = get_import_workers()
+    all_rates = get_import_rates()
     entries = []
     for location in get_locations_by_type(*IMPORTABLE).entries:
+        depths = queues.get(location.id, {})
+        rates = all_rates.get(location.id) or {'%imin' % m: 0.0 for m in RATE_WINDOWS}
+        rate = rates['%imin' % RATE_WINDOWS[1]]
+        backlog = depths.get('import_ready', 0) + depths.get('importing', 0)
         entries.append({
             'location_id': location.id,
             'location_name': location.name,
             'trig_url': get_trig_url(location.id),
+            'retry_url': get_retry_url(location.id),
+            'queue': depths,
+            'workers': workers.get(location.id, []),
+            'rate': rates,  # entries per minute
+            'eta': int(backlog / rate * 60) if rate and backlog else None,  # seconds
+            'timings': stats.get_percentiles(location.id),
         })
 
     return {
@@ -75,17 +115,22 @@ def get_importers_dict():
 
 def trig_import(location_id):
     require_admin()
-    manager = trig_import.manager
-    manager.trig(location_id)
+    bus.publish(bus.IMPORT, location_id)
     return {'result': 'ok'}
 
 
+def retry_location(location_id):
+    require_admin()
+    count = retry_failed_entries(location_id)
+    return {'result': 'ok', 'count': count}
+
+
 def upload(source, filename):
     no_guests()
     filename = re_clean.sub('_', os.path.normpath(filename))
     if '..' in filename:
         raise(bottle.HTTPError(400))
-    location = get_location_by_type(Location.Type.upload)
+    location = get_location_by_type('upload')
     folder = location.suggest_folder(source=source)
     try:
         os.makedirs(folder)
@@ -101,12 +146,14 @@ def upload(source, filename):
     )
     f = create_file(f)
     logging.info(f.to_json())
+    # Queued once the file is written, or a worker could claim it first
     e = Entry(
         files=[f],
         import_location_id=location.id,
-        state=_Entry.State.import_ready,
+        state=_Entry.State.new,
         user_id=get_current_user().id,
         source=source,
+        priority=_Entry.Priority.high,
     )
     e = create_entry(e)
     logging.info(e.to_json())
@@ -122,7 +169,13 @@ def upload(source, filename):
         disk.write(data)
     bottle.request.body.close()
 
-    trig_import(location.id)
+    with get_db().transaction() as t:
+        t.query(_Entry).filter(_Entry.id == e.id).update(
+            {_Entry.state: _Entry.State.import_ready},
+            synchronize_session=False,
+        )
+    e.state = _Entry.State.import_ready
+    bus.publish(bus.IMPORT, location.id, 1)
 
     return e.to_json()
 
@@ -135,6 +188,10 @@ def get_trig_url(location_id):
     return '%s/trig/%i' % (App.BASE, location_id)
 
 
+def get_retry_url(location_id):
+    return '%s/retry/%i' % (App.BASE, location_id)
+
+
 def get_reset_url(import_job_id):
     return '%s/job/%i/reset' % (App.BASE, import_job_id)
 
@@ -155,29 +212,322 @@ def get_import_module(mime_type):
 
 
 class GenericImportModule(object):
-    def __init__(self, entry):
+    """
+    Base for import modules. `source` is the source file of the entry,
+    opened for binary reading, for modules that want to read it without
+    opening it again.
+    """
+    def __init__(self, entry, source=None):
         self.entry = entry
+        self.source = source
+        self.timings = {}
+
+    @contextmanager
+    def timed(self, stage):
+        """
+        Add the time spent in the block to the timing of `stage`, in
+        milliseconds.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = int((time.monotonic() - start) * 1000)
+            self.timings[stage] = self.timings.get(stage, 0) + elapsed
 
 
 # API
 #####
 
 
-def pick_up_import_ready_entry(location_id):
+def get_worker_id():
+    """
+    Identify the calling worker thread uniquely across hosts and processes.
+    """
+    return '%s:%i:%s' % (socket.gethostname(), os.getpid(), current_thread().name)
+
+
+class FairScheduler:
+    """
+    Decides whose entries to claim next on a location. Only entries of the
+    highest waiting priority are considered. Among the users waiting at
+    that priority, the one with the fewest entries in flight (in any
+    process) relative to its weight goes first, ties broken by who was
+    served least recently by this process. Users weigh 1 unless given
+    another weight in `weights` (user id -> weight).
+    """
+    def __init__(self, weights=None):
+        self.weights = weights or {}
+        self.turn = 0
+        self.last_served = {}
+        self.lock = Lock()
+
+    def choose(self, user_ids, in_flight):
+        with self.lock:
+            user_id = min(user_ids, key=lambda user_id: (
+                in_flight.get(user_id, 0) / self.weights.get(user_id, 1),
+                self.last_served.get(user_id, 0),
+            ))
+            self.turn += 1
+            self.last_served[user_id] = self.turn
+            return user_id
+
+
+scheduler = FairScheduler()
+
+
+def claim_import_ready_entries(location_id, worker_id, limit=1, lease_time=LEASE_TIME):
+    """
+    Atomically move up to `limit` `import_ready` entries on a location to
+    `importing`, marking them with `worker_id` and a lease that expires
+    `lease_time` seconds from now. The entries are picked by `scheduler`,
+    oldest first for the chosen user and priority. The claim is a single
+    UPDATE, so any number of workers, in any number of processes, can claim
+    from the same queue without getting the same entry.
+
+    The highest waiting priority and the users waiting at it are found with
+    a few seeks on the entry_import_claim index, one per user, so a claim
+    costs the same with a backlog of ten entries or of fifty thousand.
+
+    Returns the claimed entries, oldest first.
+    """
+    lease_ts = (
+        datetime.datetime.utcnow() + datetime.timedelta(seconds=lease_time)
+    ).replace(microsecond=0)
+
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    waiting = (
+        (_Entry.import_location_id == location_id) &
+        (_Entry.state == _Entry.State.import_ready) &
+        ((_Entry.retry_ts.is_(None)) | (_Entry.retry_ts <= now))
+    )
+
     with get_db().transaction() as t:
-        try:
-            entry = t.query(_Entry).filter(
+        top = t.query(_Entry.priority).filter(waiting).order_by(
+            _Entry.priority.desc()).limit(1).first()
+        if top is None:
+            return []
+        priority = top[0]
+
+        user_ids = []
+        while True:
+            q = t.query(_Entry.user_id).filter(waiting, _Entry.priority == priority)
+            if user_ids:
+                q = q.filter(_Entry.user_id > user_ids[-1])
+            row = q.order_by(_Entry.user_id).limit(1).first()
+            if row is None:
+                break
+            user_ids.append(row[0])
+
+        in_flight = {}
+        if len(user_ids) > 1:
+            in_flight = dict(t.query(_Entry.user_id, func.count(_Entry.id)).filter(
                 _Entry.import_location_id == location_id,
-                _Entry.state == _Entry.State.import_ready,
-            ).order_by(_Entry.create_ts).first()
-            if entry is None:
-                return None
+                _Entry.state == _Entry.State.importing,
+                _Entry.user_id.in_(user_ids),
+            ).group_by(_Entry.user_id).all())
+        user_id = scheduler.choose(user_ids, in_flight)
+
+        ids = [row[0] for row in t.query(_Entry.id).filter(
+            waiting,
+            _Entry.priority == priority,
+            _Entry.user_id == user_id,
+        ).order_by(_Entry.id).limit(limit)]
+
+        # Another worker may have claimed some of them since, and the
+        # leases of this worker's earlier claims can share their lease_ts,
+        # so only the candidates that this claim changed are returned
+        claimed = t.query(_Entry).filter(
+            _Entry.id.in_(ids),
+            _Entry.state == _Entry.State.import_ready,
+        ).update(
+            {
+                _Entry.state: _Entry.State.importing,
+                _Entry.worker_id: worker_id,
+                _Entry.lease_ts: lease_ts,
+                _Entry.attempts: _Entry.attempts + 1,
+            },
+            synchronize_session=False,
+        )
+        if not claimed:
+            return []
 
-            entry.state = _Entry.State.importing
-            return Entry.map_in(entry)
+        entries = t.query(_Entry).filter(
+            _Entry.id.in_(ids),
+            _Entry.worker_id == worker_id,
+            _Entry.state == _Entry.State.importing,
+        ).order_by(_Entry.id).all()
+        return [Entry.map_in(entry) for entry in entries]
 
-        except NoResultFound:
-            return None
+
+def get_queue_depths():
+    """
+    Count the entries waiting, being imported and failed on each location,
+    as {location_id: {state name: count}}.
+    """
+    states = (
+        _Entry.State.import_ready,
+        _Entry.State.importing,
+        _Entry.State.import_failed,
+    )
+    depths = {}
+    with get_db().transaction() as t:
+        rows = t.query(
+            _Entry.import_location_id, _Entry.state, func.count(_Entry.id)
+        ).filter(
+            _Entry.state.in_(states),
+        ).group_by(_Entry.import_location_id, _Entry.state).all()
+
+    for location_id, state, count in rows:
+        depths.setdefault(location_id, {s.name: 0 for s in states})
+        depths[location_id][_Entry.State(state).name] = count
+    return depths
+
+
+def get_import_rates():
+    """
+    Count the entries brought online on each location per minute, over each
+    of the RATE_WINDOWS, as {location_id: {'1min': rate, ...}}. The counts
+    come from the database, so they cover the workers of all processes,
+    and are ranges over the entry_imported index.
+    """
+    now = datetime.datetime.utcnow()
+    rates = {}
+    with get_db().transaction() as t:
+        for minutes in RATE_WINDOWS:
+            since = now - datetime.timedelta(minutes=minutes)
+            rows = t.query(_Entry.import_location_id, func.count(_Entry.id)).filter(
+                _Entry.state == _Entry.State.online,
+                _Entry.import_ts >= since,
+            ).group_by(_Entry.import_location_id).all()
+            for location_id, count in rows:
+                rates.setdefault(location_id, {
+                    '%imin' % m: 0.0 for m in RATE_WINDOWS
+                })['%imin' % minutes] = round(count / minutes, 2)
+    return rates
+
+
+def get_import_workers():
+    """
+    List the workers, in any process, holding entries on each location, as
+    {location_id: [{'worker_id': ..., 'entries': [...], 'lease_ts': ...}]}.
+    """
+    with get_db().transaction() as t:
+        rows = t.query(
+            _Entry.import_location_id, _Entry.worker_id, _Entry.id, _Entry.lease_ts
+        ).filter(
+            _Entry.state == _Entry.State.importing,
+        ).order_by(_Entry.worker_id, _Entry.create_ts).all()
+
+    workers = {}
+    for location_id, worker_id, entry_id, lease_ts in rows:
+        location_workers = workers.setdefault(location_id, [])
+        if not location_workers or location_workers[-1]['worker_id'] != worker_id:
+            location_workers.append({
+                'worker_id': worker_id,
+                'entries': [],
+                'lease_ts': lease_ts.strftime('%Y-%m-%d %H:%M:%S') if lease_ts else None,
+            })
+        location_workers[-1]['entries'].append(entry_id)
+    return workers
+
+
+def renew_leases(worker_id, lease_time=LEASE_TIME):
+    """
+    Extend the leases of all entries currently held by `worker_id`, so that
+    a long batch is not reaped while it is still being worked on.
+    """
+    lease_ts = (
+        datetime.datetime.utcnow() + datetime.timedelta(seconds=lease_time)
+    ).replace(microsecond=0)
+
+    with get_db().transaction() as t:
+        t.query(_Entry).filter(
+            _Entry.worker_id == worker_id,
+            _Entry.state == _Entry.State.importing,
+        ).update(
+            {_Entry.lease_ts: lease_ts},
+            synchronize_session=False,
+        )
+
+
+@contextmanager
+def keep_leases(worker_id, lease_time=LEASE_TIME):
+    """
+    Renew the leases of `worker_id` from a heartbeat thread, several times
+    per `lease_time`, while the block runs. An entry that takes longer than
+    `lease_time` to import is then not reaped and claimed by another worker
+    while this one is still at it.
+    """
+    stop = Event()
+
+    def heartbeat():
+        while not stop.wait(max(lease_time / LEASE_RENEWALS, 1)):
+            try:
+                renew_leases(worker_id, lease_time)
+            except Exception as e:
+                logging.error("Renewing import leases failed %s", str(e))
+
+    thread = Thread(target=heartbeat, name=current_thread().name + ".Lease")
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def reap_expired_leases(max_attempts=MAX_ATTEMPTS):
+    """
+    Return `importing` entries whose lease has expired to `import_ready`, so
+    that work held by a crashed worker is picked up again. Entries that have
+    already been attempted `max_attempts` times are failed instead.
+
+    Returns the ids of the locations that got entries back.
+    """
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    expired = (
+        (_Entry.state == _Entry.State.importing) &
+        ((_Entry.lease_ts < now) | (_Entry.lease_ts.is_(None)))
+    )
+
+    with get_db().transaction() as t:
+        exhausted = t.query(_Entry).filter(
+            expired,
+            _Entry.attempts >= max_attempts,
+        ).all()
+        exhausted = [Entry.map_in(entry) for entry in exhausted]
+
+    for entry in exhausted:
+        fail_import(entry, "Import lease expired after %i attempts" % max_attempts)
+
+    with get_db().transaction() as t:
+        location_ids = [
+            row.import_location_id for row in
+            t.query(_Entry.import_location_id).filter(expired).distinct()
+        ]
+        released = t.query(_Entry).filter(expired).update(
+            {
+                _Entry.state: _Entry.State.import_ready,
+                _Entry.worker_id: None,
+                _Entry.lease_ts: None,
+            },
+            synchronize_session=False,
+        )
+
+    if released:
+        logging.warning("Released %i entries with expired import leases", released)
+    return location_ids
+
+
+def pick_up_import_ready_entry(location_id):
+    """
+    Claim the oldest `import_ready` entry on a location for the calling
+    worker, or return None if there is nothing to import.
+    """
+    entries = claim_import_ready_entries(location_id, get_worker_id())
+    return entries[0] if entries else None
 
 
 def fail_import(entry, reason):
@@ -190,12 +540,64 @@ def fail_import(entry, reason):
         e.data = metadata.to_json()
 
 
+def retry_import(entry, reason, delay):
+    """
+    Put an entry back in the queue, to be claimed again no sooner than
+    `delay` seconds from now. The claim query skips it until then, and the
+    idle wakeups of the workers pick it up after.
+    """
+    logging.warning("%s, retrying in %i seconds", reason, delay)
+    retry_ts = (
+        datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+    ).replace(microsecond=0)
+
+    with get_db().transaction() as t:
+        e = t.query(_Entry).get(entry.id)
+        e.state = _Entry.State.import_ready
+        e.worker_id = None
+        e.lease_ts = None
+        e.retry_ts = retry_ts
+        metadata = wrap_raw_json(e.data) or _Entry.DefaultMetadata()
+        metadata.error = reason
+        e.data = metadata.to_json()
+
+
+def retry_failed_entries(location_id):
+    """
+    Put all failed entries on a location back in the queue with a fresh
+    attempt count. Returns the number of entries.
+    """
+    logging.info("Retrying failed entries on location %i", location_id)
+    with get_db().transaction() as t:
+        count = t.query(_Entry).filter(
+            _Entry.import_location_id == location_id,
+            _Entry.state == _Entry.State.import_failed,
+        ).update(
+            {
+                _Entry.state: _Entry.State.import_ready,
+                _Entry.worker_id: None,
+                _Entry.lease_ts: None,
+                _Entry.retry_ts: None,
+                _Entry.attempts: 0,
+            },
+            synchronize_session=False,
+        )
+    if count:
+        bus.publish(bus.IMPORT, location_id)
+    return count
+
+
 def reset_entry(entry_id):
     logging.info("Resetting entry %i", entry_id)
     with get_db().transaction() as t:
         e = t.query(_Entry).get(entry_id)
         e.state = _Entry.State.import_ready
-        trig_import(e.import_location_id)
+        e.worker_id = None
+        e.lease_ts = None
+        e.retry_ts = None
+        e.attempts = 0
+        location_id = e.import_location_id
+    bus.publish(bus.IMPORT, location_id, 1)
 
 
 # IMPORT MANAGER
@@ -204,74 +606,381 @@ def reset_entry(entry_id):
 
 class Manager:
     """
-    A Thread+Event based Import Manager that keeps one thread per location
-    and trigs a new import round upon the trig method being called.
-
-    There should only be one of these.
+    A Thread+Event based Import Manager that keeps a pool of worker threads
+    per location and wakes them up on notifications on the `bus.IMPORT`
+    topic. Idle workers also wake up by themselves every `idle_wakeup`
+    seconds to pick up work queued by other processes.
+
+    The pool size is set with `workers` in the location's config section
+    and defaults to one. Each location has its own pool, so a busy location
+    cannot take workers from another one.
+
+    A reaper thread returns entries with expired leases to the queue every
+    `reap_interval` seconds, starting right away so that a restart after a
+    crash resumes the backlog.
+
+    `locations` restricts the manager to the named locations, given as a
+    list or a comma separated string. `user_weights` gives users a larger
+    share of the workers, as a dict or as a "user_id:weight, ..." string.
+    Claims go through the database, so managers in several processes, on
+    several hosts, can share the work.
+
+    There should only be one of these per process.
     """
-    def __init__(self):
+    def __init__(
+            self,
+            lease_time=LEASE_TIME,
+            max_attempts=MAX_ATTEMPTS,
+            reap_interval=REAP_INTERVAL,
+            idle_wakeup=IDLE_WAKEUP,
+            locations=None,
+            user_weights=None):
+
         self.events = {}
-        trig_import.manager = self
+        self.next_event = {}
+        self.lease_time = int(lease_time)
+        self.max_attempts = int(max_attempts)
+        self.reap_interval = int(reap_interval)
+        self.idle_wakeup = int(idle_wakeup) or None
+        if isinstance(locations, str):
+            locations = [l.strip() for l in locations.split(',') if l.strip()]
+        if isinstance(user_weights, str):
+            user_weights = dict(
+                (int(u), float(w)) for u, w in
+                (pair.split(':') for pair in user_weights.split(',') if pair.strip())
+            )
+        scheduler.weights = user_weights or {}
 
         for location in get_locations_by_type(*IMPORTABLE).entries:
-            logging.debug("Setting up import thread [Importer%i].", location.id)
-            event = Event()
-            self.events[location.id] = event
-            thread = Thread(
-                target=importing_loop,
-                name="Importer%i" % (location.id),
-                args=(event, location)
-            )
-            thread.daemon = True
-            thread.start()
+            if locations and location.name not in locations:
+                logging.debug("Skipping import threads for %s.", location.name)
+                continue
+            workers = max(location.metadata.workers or 1, 1)
+            self.events[location.id] = []
+            self.next_event[location.id] = 0
+            for n in range(workers):
+                name = "Importer%i.%i" % (location.id, n)
+                logging.debug("Setting up import thread [%s].", name)
+                event = Event()
+                self.events[location.id].append(event)
+                thread = Thread(
+                    target=importing_loop,
+                    name=name,
+                    args=(
+                        event,
+                        location,
+                        self.lease_time,
+                        self.idle_wakeup,
+                        self.max_attempts,
+                    )
+                )
+                thread.daemon = True
+                thread.start()
 
-    def trig(self, location_id):
-        event = self.events.get(location_id)
-        if event is None:
-            raise NameError("No thread for location %i", location_id)
-        logging.info("Trigging import event for location %i", location_id)
-        event.set()
+        bus.subscribe(bus.IMPORT, self.trig)
 
+        thread = Thread(
+            target=reaping_loop,
+            name="ImportReaper",
+            args=(self, ),
+        )
+        thread.daemon = True
+        thread.start()
+
+    def trig(self, location_id, count=None):
+        """
+        Wake up `count` of the workers for a location, or all of them if
+        `count` is None. Locations without workers in this process are
+        ignored.
+        """
+        events = self.events.get(location_id)
+        if events is None:
+            logging.debug("No import thread for location %i", location_id)
+            return
+        if count is None or count >= len(events):
+            logging.info("Trigging import event for location %i", location_id)
+            for event in events:
+                event.set()
+            return
+
+        logging.info("Trigging %i import events for location %i", count, location_id)
+        first = self.next_event[location_id]
+        for n in range(first, first + count):
+            events[n % len(events)].set()
+        self.next_event[location_id] = (first + count) % len(events)
+
+
+def reaping_loop(manager):
+    """
+    A loop that releases expired import leases and trigs the importers of
+    the affected locations.
+    """
+    while True:
+        try:
+            location_ids = reap_expired_leases(manager.max_attempts)
+        except Exception as e:
+            logging.error("Reaping import leases failed %s", str(e))
+            location_ids = []
+
+        for location_id in location_ids:
+            manager.trig(location_id)
+
+        time.sleep(manager.reap_interval)
 
-def importing_loop(import_event, location):
+
+def importing_loop(
+        import_event,
+        location,
+        lease_time=LEASE_TIME,
+        idle_wakeup=IDLE_WAKEUP,
+        max_attempts=MAX_ATTEMPTS):
     """
-    An import loop that will wait for import_event to be set
-    each iteration.
+    An import loop that will wait for import_event to be set, or at most
+    `idle_wakeup` seconds, each iteration.
     """
     metadata = location.metadata
+    batch_size = max(metadata.batch_size or 1, 1)
+    worker_id = get_worker_id()
     logging.info("Started importer thread for %i:%s", location.id, metadata.folder)
     while True:
-        import_event.wait(30)
+        import_event.wait(idle_wakeup)
         import_event.clear()
 
-        while True:
-            entry = pick_up_import_ready_entry(location.id)
+        try:
+            while True:
+                entries = claim_import_ready_entries(
+                    location.id, worker_id, limit=batch_size, lease_time=lease_time)
 
-            if entry is None:
-                break
+                if not entries:
+                    break
 
-            logging.debug("Entry to import:\n%s", entry.to_json())
+                with keep_leases(worker_id, lease_time):
+                    for entry in entries:
+                        import_entry(entry, max_attempts)
+        except Exception as e:
+            # Entries left claimed are released by the reaper
+            logging.error("Importing on location %i failed %s", location.id, str(e))
 
-            mime_type = guess_mime_type(entry.source_file.full_path)
-            ImportModule = get_import_module(mime_type)
 
-            if ImportModule is None:
-                fail_import(
-                    entry,
-                    "Could not find a suitable import module for MIME Type %s" % mime_type
-                )
-                continue
+def import_entry(entry, max_attempts=MAX_ATTEMPTS):
+    """
+    Run the matching import module on a claimed entry and bring it online.
+    Transient errors, in the import or in writing the entry, put the entry
+    back in the queue with an exponential backoff until it has been
+    attempted `max_attempts` times, any other error marks it as failed.
+
+    The time spent in each stage of the import is stored in the entry's
+    metadata and added to `stats`.
+    """
+    logging.debug("Entry to import:\n%s", entry.to_json())
+
+    start = time.monotonic()
+    try:
+        timings = _import_entry(entry)
+        _finish_import(entry, timings, start)
+    except Exception as e:
+        reason = "Import failed %s" % str(e)
+        if is_transient_error(e, entry) and entry.attempts < max_attempts:
+            delay = min(RETRY_DELAY * 2 ** max(entry.attempts - 1, 0), MAX_RETRY_DELAY)
+            retry_import(entry, reason, delay)
+        else:
+            fail_import(entry, reason)
+        return
+
+    stats.add(entry.import_location_id, timings)
+    logging.debug("Imported Entry:\n%s", entry.to_json())
+
+
+def _finish_import(entry, timings, start):
+    entry.state = _Entry.State.online
+    entry.metadata = entry.metadata or _Entry.DefaultMetadata()
+    entry.metadata.error = None  # from earlier attempts
+    with get_db().transaction() as t:
+        db_start = time.monotonic()
+        e = t.query(_Entry).get(entry.id)
+        entry.map_out(e, system=True, t=t)
+        e.import_ts = datetime.datetime.utcnow()
+        t.flush()
+        timings['db'] = timings.get('db', 0) + int((time.monotonic() - db_start) * 1000)
+        timings['total'] = int((time.monotonic() - start) * 1000)
+        # The finished timings go in with the same write
+        entry.metadata.timings = timings
+        e.data = entry.metadata.to_json()
+
+
+def _import_entry(entry):
+    source_file = entry.source_file
+    with open(source_file.full_path, 'rb') as source:
+        mime_type = source_file.mime
+        if mime_type is None:
+            mime_type = detect_mime_type(source, source_file.full_path)
+            if mime_type is not None:
+                source_file.mime = mime_type
+                update_file_by_id(source_file.id, source_file)
+
+        ImportModule = get_import_module(mime_type)
+
+        if ImportModule is None:
+            raise ImportModuleMissing(
+                "Could not find a suitable import module for MIME Type %s" % mime_type
+            )
+
+        import_module = ImportModule(entry, source=source)
+        import_module.run()
+        return import_module.timings
+
+
+# IMPORT STATISTICS
+###################
+
+
+class ImportStats:
+    """
+    Keeps the stage timings of the last `window` imports per location done
+    by this process, for percentiles on the importer feed.
+    """
+    def __init__(self, window=STATS_WINDOW):
+        self.window = window
+        self.timings = {}
+        self.lock = Lock()
+
+    def add(self, location_id, timings):
+        with self.lock:
+            if location_id not in self.timings:
+                self.timings[location_id] = deque(maxlen=self.window)
+            self.timings[location_id].append(timings)
+
+    def get_percentiles(self, location_id, percentiles=(50, 90, 99)):
+        """
+        Return {stage: {'count': n, 'p50': ms, ...}} for a location.
+        """
+        with self.lock:
+            recent = list(self.timings.get(location_id, ()))
+
+        stages = {}
+        for timings in recent:
+            for stage, ms in timings.items():
+                stages.setdefault(stage, []).append(ms)
+
+        result = {}
+        for stage, values in stages.items():
+            values.sort()
+            result[stage] = {'count': len(values)}
+            for p in percentiles:
+                index = min(int(len(values) * p / 100), len(values) - 1)
+                result[stage]['p%i' % p] = values[index]
+        return result
+
+
+stats = ImportStats()
+
+
+# ERROR CLASSIFICATION
+######################
+
+
+class TransientImportError(Exception):
+    """
+    Raised by import modules for errors that may go away if the import is
+    tried again later.
+    """
+    pass
+
+
+class ImportModuleMissing(Exception):
+    pass
+
+
+transient_errnos = {
+    errno.EAGAIN,
+    errno.EBUSY,
+    errno.EINTR,
+    errno.EIO,
+    errno.EMFILE,
+    errno.ENFILE,
+    errno.ENOSPC,
+    errno.ENOTCONN,
+    errno.ESTALE,
+    errno.ETIMEDOUT,
+    errno.ECONNABORTED,
+    errno.ECONNRESET,
+    errno.EHOSTDOWN,
+    errno.EHOSTUNREACH,
+    errno.ENETDOWN,
+    errno.ENETUNREACH,
+}
+
+
+def is_transient_error(e, entry):
+    """
+    Tell whether an import error is likely to go away by itself, like a
+    busy database or a drop folder on a network drive that is briefly
+    unmounted.
+    """
+    if isinstance(e, TransientImportError):
+        return True
+    if isinstance(e, OperationalError):
+        return True
+    if isinstance(e, OSError):
+        if e.errno in transient_errnos:
+            return True
+        if e.errno == errno.ENOENT:
+            # A missing file is only permanent if its location is there
+            location = entry.source_file.location
+            return not os.path.isdir(location.root)
+    return False
+
+
+# MIME TYPE DETECTION
+#####################
+
+SNIFF_SIZE = 16
+
+# TIFF based raw formats can only be told apart by their extension
+tiff_raw_mime_types = {
+    'arw': 'image/x-sony-arw',
+    'dng': 'image/x-adobe-dng',
+    'nef': 'image/x-nikon-nef',
+    'nrw': 'image/x-nikon-nrw',
+    'pef': 'image/x-pentax-pef',
+    'sr2': 'image/x-sony-sr2',
+    'srw': 'image/x-samsung-srw',
+}
+
+
+def detect_mime_type(source, file_path):
+    """
+    Detect the MIME Type of an open file from its first bytes, falling back
+    to guessing from the file name. Leaves `source` at the start of the file.
+    """
+    header = source.read(SNIFF_SIZE)
+    source.seek(0)
+    mime_type = sniff_mime_type(header, file_path)
+    if mime_type is None:
+        return guess_mime_type(file_path)
+    logging.debug("Detected MIME Type '%s' for '%s'", mime_type, file_path)
+    return mime_type
 
-            import_module = ImportModule(entry)
-            try:
-                import_module.run()
-            except Exception as e:
-                fail_import(entry, "Import failed %s" % str(e))
-                continue
 
-            entry.state = _Entry.State.online
-            entry = update_entry_by_id(entry.id, entry, system=True)
-            logging.debug("Imported Entry:\n%s", entry.to_json())
+def sniff_mime_type(header, file_path=''):
+    if header[:3] == b'\xFF\xD8\xFF':
+        return 'image/jpeg'
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        if header[8:10] == b'CR':
+            return 'image/x-canon-cr2'
+        extension = file_path.rsplit('.', 1)[-1].lower()
+        return tiff_raw_mime_types.get(extension, 'image/tiff')
+    if header[:4] in (b'IIRO', b'IIRS', b'MMOR'):
+        return 'image/x-olympus-orf'
+    if header[:4] == b'IIU\x00':
+        return 'image/x-panasonic-rw2'
+    if header[:15] == b'FUJIFILMCCD-RAW':
+        return 'image/x-fuji-raf'
+    if header[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    return None
 
 
 def guess_mime_type(file_path):
@@ -8,7 +8,7 @@ from datetime import datetime
 
 from ..importer import GenericImportModule, register_import_module
 from ..localfile import FileCopy
-from ..entry import _Entry
+from ..entry import _Entry, promote_property
 from ..file import File, _File, create_file
 from ..location import get_location_by_type
 from ..exif import exif_position, exif_orientation, exif_string, exif_int, exif_ratio
@@ -24,14 +24,18 @@ class JPEGImportModule(GenericImportModule):
     def run(self):
         self.entry.original_filename = os.path.basename(self.entry.source_file.path)
 
-        self.image_location = get_location_by_type('image')
-        self.thumb_location = get_location_by_type('thumb')
-        self.proxy_location = get_location_by_type('proxy')
+        with self.timed('db'):
+            self.image_location = get_location_by_type('image')
+            self.thumb_location = get_location_by_type('thumb')
+            self.proxy_location = get_location_by_type('proxy')
 
-        self.copy_original()
-        phmd = JPEGMetadata(**(self.analyse()))
+        with self.timed('copy_original'):
+            self.copy_original()
+        with self.timed('analyse'):
+            phmd = JPEGMetadata(**(self.analyse()))
 
-        self.correct_folder(phmd)
+        with self.timed('correct_folder'):
+            self.correct_folder(phmd)
 
         f = File(
            path=self.image_rel_path,
@@ -40,7 +44,8 @@ class JPEGImportModule(GenericImportModule):
            purpose=_File.Purpose.primary,
            mime=self.entry.source_file.mime,
         )
-        f = create_file(f)
+        with self.timed('db'):
+            f = create_file(f)
         self.entry.files.append(f)
 
         angle, mirror = phmd.Angle, phmd.Mirror
@@ -91,7 +96,8 @@ class JPEGImportModule(GenericImportModule):
 
     def create_thumbnail(self, angle, mirror):
         thumb_path = os.path.join(self.thumb_location.root, self.image_rel_path)
-        create_thumbnail(self.image_path, thumb_path, angle=angle, mirror=mirror)
+        with self.timed('create_thumbnail'):
+            create_thumbnail(self.image_path, thumb_path, angle=angle, mirror=mirror)
         s = os.stat(thumb_path)
         f = File(
            path=self.image_rel_path,
@@ -100,12 +106,14 @@ class JPEGImportModule(GenericImportModule):
            purpose=_File.Purpose.thumb,
            mime="image/jpeg"
         )
-        f = create_file(f)
+        with self.timed('db'):
+            f = create_file(f)
         self.entry.files.append(f)
 
     def create_proxy(self, angle, mirror):
         proxy_path = os.path.join(self.proxy_location.root, self.image_rel_path)
-        convert(self.image_path, proxy_path, angle=angle, mirror=mirror)
+        with self.timed('create_proxy'):
+            convert(self.image_path, proxy_path, angle=angle, mirror=mirror)
         s = os.stat(proxy_path)
         f = File(
            path=self.image_rel_path,
@@ -114,18 +122,23 @@ class JPEGImportModule(GenericImportModule):
            purpose=_File.Purpose.proxy,
            mime="image/jpeg"
         )
-        f = create_file(f)
+        with self.timed('db'):
+            f = create_file(f)
         self.entry.files.append(f)
 
     def analyse(self):
         infile = self.image_path
 
         exif = None
-        with open(infile, 'rb') as f:
-            exif = exifread.process_file(f)
+        if self.source is not None:
+            self.source.seek(0)
+            exif = exifread.process_file(self.source)
+        else:
+            with open(infile, 'rb') as f:
+                exif = exifread.process_file(f)
 
         orientation, mirror, angle = exif_orientation(exif)
-        lon, lat = exif_position(exif)
+        lat, lon = exif_position(exif)
         logging.debug(exif)
 
         return {
@@ -182,12 +195,22 @@ class JPEGMetadata(_Entry.DefaultPhysicalMetadata):
     Software = Property()
     SubjectDistanceRange = Property(int)
     WhiteBalance = Property()
-    Latitude = Property()
-    Longitude = Property()
+    Latitude = Property(float)
+    Longitude = Property(float)
 
 
 register_metadata_schema(JPEGMetadata)
 
+# Indexed for filtering and sorting
+promote_property('Make')
+promote_property('Model')
+promote_property('Orientation')
+promote_property('ISOSpeedRatings', float)
+promote_property('FocalLength', float)
+promote_property('FocalLengthIn35mmFilm', float)
+promote_property('FNumber', float)
+promote_property('ExposureTime', float)
+
 
 def create_thumbnail(path_in, path_out, override=False, size=THUMB_SIZE, angle=None, mirror=None):
     if os.path.exists(path_out) and not override:
@@ -0,0 +1,109 @@
+"""Minimal bindings to the Linux inotify API through ctypes"""
+
+import os
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_event = struct.Struct('iIII')  # wd, mask, cookie, len
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        try:
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        _libc = libc
+    return _libc
+
+
+def _error(path=None):
+    e = ctypes.get_errno()
+    return OSError(e, os.strerror(e), path)
+
+
+class Inotify(object):
+    """
+    An inotify instance. Raises OSError if inotify is not available.
+
+    Events are read as tuples of (wd, mask, cookie, name), where name is
+    the name of the file within the watched directory, or '' for events on
+    the directory itself.
+    """
+    def __init__(self):
+        self.libc = _get_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise _error()
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise _error(path)
+        return wd
+
+    def rm_watch(self, wd):
+        if self.libc.inotify_rm_watch(self.fd, wd) < 0:
+            raise _error()
+
+    def read(self, timeout=None, wake_fd=None):
+        """
+        Wait at most `timeout` seconds (forever if None) for events, or for
+        `wake_fd` to become readable, and return the available events.
+        """
+        fds = [self.fd] if wake_fd is None else [self.fd, wake_fd]
+        try:
+            readable, _, _ = select.select(fds, [], [], timeout)
+        except InterruptedError:
+            return []
+        if self.fd not in readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + _event.size <= len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, offset)
+            offset += _event.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
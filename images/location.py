@@ -35,6 +35,12 @@ class _Location(Base):
         tags = Property(list)
         read_only = Property(bool)
         wants = Property(list)  # File.Purpose
+        workers = Property(int, default=1)
+        batch_size = Property(int, default=1)
+        watch = Property(bool, default=False)
+        scan_workers = Property(int, default=1)
+        settle_time = Property(int, default=10)  # seconds
+        reconcile_interval = Property(int, default=3600)  # seconds
 
     id = Column(Integer, primary_key=True)
     type = Column(String(128), nullable=True)
@@ -0,0 +1,287 @@
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+from samtt import Base
+
+from . import geohash
+from .entry import _Entry, SEARCH_TABLE, make_search_text
+from .metadata import wrap_raw_json
+from .tag import _Tag, _EntryToTag, recount_tags
+
+
+BATCH_SIZE = 1000  # rows
+
+
+def migrate(db):
+    """
+    Bring the tables of an existing database up to date with the models.
+
+    `create_all` only creates missing tables, so this adds the columns and
+    indexes that have been added to the models since, and then runs the
+    data migrations. Every step is safe to run again. The cleanups run
+    before the indexes are created, for data that would break a unique one.
+    """
+    with db.transaction() as t:
+        connection = t.connection()
+        inspector = inspect(connection)
+        tables = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name in tables:
+                add_missing_columns(connection, inspector, table)
+
+        for step in cleanups:
+            logging.debug("Migration cleanup %s...", step.__name__)
+            step(t)
+
+        for table in Base.metadata.sorted_tables:
+            if table.name in tables:
+                add_missing_indexes(connection, inspector, table)
+
+    with db.transaction() as t:
+        for step in steps:
+            logging.debug("Migration step %s...", step.__name__)
+            step(t)
+
+
+def add_missing_columns(connection, inspector, table):
+    existing = {c['name'] for c in inspector.get_columns(table.name)}
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        logging.info("Adding column %s.%s...", table.name, column.name)
+        ddl = '%s %s' % (column.name, column.type.compile(dialect=connection.dialect))
+        default = column.default
+        if default is not None and default.is_scalar:
+            value = default.arg
+            if isinstance(value, int):
+                value = int(value)  # IntEnum
+            ddl += ' DEFAULT %r' % (value, )
+            if not column.nullable:
+                ddl += ' NOT NULL'
+        connection.execute(text('ALTER TABLE %s ADD COLUMN %s' % (table.name, ddl)))
+
+
+def add_missing_indexes(connection, inspector, table):
+    existing = {i['name'] for i in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name in existing:
+            continue
+        logging.info("Creating index %s...", index.name)
+        index.create(bind=connection)
+
+
+# DATA MIGRATIONS
+#################
+
+
+def rebuild_tag_tables(t):
+    """
+    Tag ids used to be declared as integers. In SQLite an INTEGER PRIMARY
+    KEY is the rowid, which refuses the text ids tags have everywhere
+    else, so tag and entry_to_tag are created anew with text keys and the
+    rows are copied over. Links to deleted entries and duplicate links are
+    left behind.
+    """
+    if t.get_bind().dialect.name != 'sqlite':
+        return
+    columns = {
+        row[1]: row[2] for row in t.execute(text('PRAGMA table_info(tag)'))
+    }
+    if columns.get('id', '').upper() != 'INTEGER':
+        return
+
+    logging.info("Rebuilding the tag tables with text ids...")
+    t.execute(text('ALTER TABLE entry_to_tag RENAME TO entry_to_tag_old'))
+    t.execute(text('ALTER TABLE tag RENAME TO tag_old'))
+    for index in _EntryToTag.__table__.indexes:
+        # Index names are per database, so the old table still holds them
+        t.execute(text('DROP INDEX IF EXISTS %s' % index.name))
+    connection = t.connection()
+    _Tag.__table__.create(bind=connection)
+    _EntryToTag.__table__.create(bind=connection)
+
+    copied = [c.name for c in _Tag.__table__.columns if c.name in columns]
+    t.execute(text(
+        'INSERT INTO tag (%(columns)s) SELECT %(values)s FROM tag_old' % {
+            'columns': ', '.join(copied),
+            'values': ', '.join(
+                'CAST(id AS TEXT)' if name == 'id' else name for name in copied),
+        }
+    ))
+    t.execute(text(
+        'INSERT INTO entry_to_tag (id, entry_id, tag_id) '
+        'SELECT MIN(id), entry_id, CAST(tag_id AS TEXT) FROM entry_to_tag_old '
+        'WHERE entry_id IN (SELECT id FROM entry) AND tag_id IS NOT NULL '
+        'GROUP BY entry_id, tag_id'
+    ))
+    t.execute(text('DROP TABLE entry_to_tag_old'))
+    t.execute(text('DROP TABLE tag_old'))
+
+
+def remove_orphan_entry_tags(t):
+    """
+    Deleting an entry used to leave its tag links behind.
+    """
+    t.execute(text(
+        'DELETE FROM entry_to_tag WHERE entry_id NOT IN (SELECT id FROM entry)'
+    ))
+
+
+def dedupe_entry_tags(t):
+    """
+    Entries could be linked to the same tag more than once.
+    """
+    t.execute(text(
+        'DELETE FROM entry_to_tag WHERE id NOT IN '
+        '(SELECT MIN(id) FROM entry_to_tag GROUP BY tag_id, entry_id)'
+    ))
+
+
+def backfill_taken_ts(t):
+    """
+    The entry feed pages on taken_ts, which used to be nullable.
+    """
+    t.query(_Entry).filter(_Entry.taken_ts.is_(None)).update(
+        {_Entry.taken_ts: _Entry.create_ts},
+        synchronize_session=False,
+    )
+
+
+def normalise_timestamps(t):
+    """
+    SQLite used to fill in the entry timestamps without fractional seconds,
+    which sort before the same second written with them, as the feed
+    cursors are. Only SQLite stores them as text.
+    """
+    if t.get_bind().dialect.name != 'sqlite':
+        return
+    for name in TIMESTAMP_COLUMNS:
+        t.execute(text(
+            "UPDATE entry SET %(name)s = %(name)s || '.000000' "
+            "WHERE length(%(name)s) = 19" % {'name': name}
+        ))
+
+
+TIMESTAMP_COLUMNS = ('create_ts', 'update_ts', 'taken_ts')
+
+
+def drop_obsolete_indexes(t):
+    """
+    Indexes that have been replaced by better ones.
+    """
+    for name in OBSOLETE_INDEXES:
+        t.execute(text('DROP INDEX IF EXISTS %s' % name))
+
+
+OBSOLETE_INDEXES = (
+    'entry_import_queue',  # entry_import_claim
+    'entry_recent',  # entry_imported
+)
+
+
+cleanups = [
+    drop_obsolete_indexes,
+    rebuild_tag_tables,
+    remove_orphan_entry_tags,
+    dedupe_entry_tags,
+]
+
+
+def backfill_geohash(t):
+    """
+    Entries positioned before the geohash column existed.
+    """
+    while True:
+        rows = t.query(_Entry.id, _Entry.latitude, _Entry.longitude).filter(
+            _Entry.geohash.is_(None),
+            _Entry.latitude.isnot(None),
+            _Entry.longitude.isnot(None),
+        ).limit(BATCH_SIZE).all()
+        if not rows:
+            break
+        for id, latitude, longitude in rows:
+            t.query(_Entry).filter(_Entry.id == id).update(
+                {_Entry.geohash: geohash.encode(latitude, longitude)},
+                synchronize_session=False,
+            )
+
+
+def backfill_search_text(t):
+    """
+    Entries created before search_text existed.
+    """
+    while True:
+        rows = t.query(
+            _Entry.id, _Entry.original_filename, _Entry.data, _Entry.physical_data,
+        ).filter(_Entry.search_text.is_(None)).limit(BATCH_SIZE).all()
+        if not rows:
+            break
+        for id, original_filename, data, physical_data in rows:
+            t.query(_Entry).filter(_Entry.id == id).update(
+                {_Entry.search_text: make_search_text(
+                    original_filename, _wrap(data), _wrap(physical_data))},
+                synchronize_session=False,
+            )
+
+
+def _wrap(json_string):
+    try:
+        return wrap_raw_json(json_string)
+    except (ValueError, NameError):
+        return None
+
+
+def create_search_index(t):
+    """
+    An FTS5 index over entry.search_text, kept in sync by triggers. Without
+    SQLite or FTS5, searching falls back to scanning search_text.
+    """
+    if t.get_bind().dialect.name != 'sqlite':
+        return
+    if t.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type='table' AND name=:name"),
+        {'name': SEARCH_TABLE},
+    ).first() is not None:
+        return
+
+    try:
+        t.execute(text(
+            "CREATE VIRTUAL TABLE %s USING fts5("
+            "search_text, content='entry', content_rowid='id')" % SEARCH_TABLE
+        ))
+    except OperationalError:
+        logging.warning("SQLite has no FTS5, searching entries without an index")
+        return
+
+    logging.info("Building the search index...")
+    for trigger in SEARCH_TRIGGERS:
+        t.execute(text(trigger % {'table': SEARCH_TABLE}))
+    t.execute(text("INSERT INTO %(table)s(%(table)s) VALUES ('rebuild')" % {
+        'table': SEARCH_TABLE}))
+
+
+SEARCH_TRIGGERS = (
+    "CREATE TRIGGER %(table)s_insert AFTER INSERT ON entry BEGIN "
+    "INSERT INTO %(table)s(rowid, search_text) VALUES (new.id, new.search_text); "
+    "END",
+    "CREATE TRIGGER %(table)s_delete AFTER DELETE ON entry BEGIN "
+    "INSERT INTO %(table)s(%(table)s, rowid, search_text) "
+    "VALUES ('delete', old.id, old.search_text); "
+    "END",
+    "CREATE TRIGGER %(table)s_update AFTER UPDATE OF search_text ON entry BEGIN "
+    "INSERT INTO %(table)s(%(table)s, rowid, search_text) "
+    "VALUES ('delete', old.id, old.search_text); "
+    "INSERT INTO %(table)s(rowid, search_text) VALUES (new.id, new.search_text); "
+    "END",
+)
+
+
+steps = [
+    backfill_taken_ts,
+    normalise_timestamps,
+    recount_tags,  # also repairs counts that have drifted
+    backfill_geohash,
+    backfill_search_text,
+    create_search_index,
+]
@@ -1,15 +1,47 @@
 import os
+import json
+import time
+import queue
 import logging
 import bottle
 
-from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock
+from sqlalchemy import Column, Integer, Float, String, Text, ForeignKey, UniqueConstraint
+from samtt import Base, get_db
 
+from . import bus
+from . import inotify
 from .location import get_locations_by_type, SCANNABLE
-from .file import _File, File, create_file
-from .entry import _Entry, Entry, create_entry
+from .file import _File, File, KnownPaths, get_managed_paths
+from .entry import _Entry, Entry, create_entries
 from .user import authenticate, require_admin, no_guests
 
 
+IDLE_WAKEUP = 30  # seconds, 0 to only scan on notifications
+MTIME_GRACE = 2  # seconds, folder mtimes more recent than this are not trusted
+BATCH_SIZE = 500  # files registered per transaction
+QUEUE_SIZE = 1000  # folder listings waiting to be registered
+SETTLE_TIME = 10  # seconds a new file must be left alone before it is registered
+
+
+# DB MODEL
+##########
+
+
+class _ScannedFolder(Base):
+    __tablename__ = 'scanned_folder'
+    __table_args__ = (
+        UniqueConstraint('location_id', 'path', name='scanned_folder_constraint'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    location_id = Column(Integer, ForeignKey('location.id'), nullable=False)
+    path = Column(String(256), nullable=False)
+    mtime = Column(Float)
+    data = Column(Text)  # {"files": [...], "folders": [...]}
+
+
 # WEB
 #####
 
@@ -54,8 +86,7 @@ def get_scanners_dict():
 
 def trig_scan(location_id):
     require_admin()
-    manager = trig_scan.manager
-    manager.trig(location_id)
+    bus.publish(bus.SCAN, location_id)
     return {'result': 'ok'}
 
 
@@ -69,19 +100,346 @@ def get_trig_url(location_id):
 
 class FolderScanner(object):
     """
-    A simple recursive folder scanner.
+    A recursive folder scanner that only reports files it has not reported
+    before, once they are done being written.
+
+    The scanner keeps a snapshot of the mtime and the file and folder names
+    of every folder it has listed, as {path: (mtime, files, folders)}. A
+    folder whose mtime has not changed since it was listed is not listed
+    again, the scanner only descends into its known sub folders. Pass a
+    snapshot from `load_snapshot` to keep it across restarts, `changed` and
+    `removed` tell what to store after a scan.
+
+    A new file modified within the last `settle` seconds may still be
+    being copied in. It is held back as pending until a later scan sees it
+    with the same size and mtime, or it has been left alone for `settle`
+    seconds. Pending files are checked with a stat each at the start of
+    every scan, and are left out of the snapshot until reported. Each
+    observation is tagged with the scan that made it, and only compared
+    with one from an earlier scan, so seeing a file twice in one scan
+    proves nothing.
+
+    With `workers` above one, folders are listed concurrently on a thread
+    pool, which pays off on network file systems where each listing is
+    mostly waiting.
     """
-    def __init__(self, basepath, ext=None):
+    def __init__(self, basepath, ext=None, snapshot=None, workers=1, settle=SETTLE_TIME):
         self.basepath = basepath
         self.ext = ext
+        self.workers = workers
+        self.settle = settle
+        self.snapshot = snapshot if snapshot is not None else {}
+        self.pending = {}  # path -> (size, mtime, generation)
+        self.generation = 0  # scans started
+        self.changed = set()
+        self.removed = set()
 
     def scan(self):
-        for r, ds, fs in os.walk(self.basepath):
-            for f in fs:
-                if not self.ext or f.split('.')[-1].lower() in self.ext:
-                    p = os.path.relpath(os.path.join(r, f), self.basepath)
-                    if not p.startswith('.'):
-                        yield p
+        self.generation += 1
+        self.changed = set()
+        visited = set()
+
+        for p in self._check_pending():
+            yield p
+
+        if self.workers > 1:
+            listings = self._walk_parallel()
+        else:
+            listings = self._walk()
+
+        for folder, paths in listings:
+            visited.add(folder)
+            for p in paths:
+                yield p
+
+        self.removed = set(self.snapshot) - visited
+        for folder in self.removed:
+            del self.snapshot[folder]
+
+    def _wanted(self, p):
+        if self.ext and p.split('.')[-1].lower() not in self.ext:
+            return False
+        return not p.startswith('.')
+
+    def _is_stable(self, p, st):
+        """
+        Tell if a file is done being written, holding it as pending if not.
+        """
+        observed = (st.st_size, st.st_mtime)
+        previous = self.pending.get(p)
+        if time.time() - st.st_mtime >= self.settle:
+            self.pending.pop(p, None)
+            return True
+        if previous is not None and previous[2] == self.generation:
+            # Already seen in this scan, compare with it in the next one
+            return False
+        if previous is not None and previous[:2] == observed:
+            self.pending.pop(p, None)
+            return True
+        self.pending[p] = observed + (self.generation, )
+        return False
+
+    def _check_pending(self):
+        """
+        Return the pending files that have become stable, adding them to
+        the snapshot of their folders.
+        """
+        stable = []
+        for p in list(self.pending):
+            try:
+                st = os.stat(os.path.join(self.basepath, p))
+            except FileNotFoundError:
+                del self.pending[p]
+                continue
+            if self._is_stable(p, st):
+                stable.append(p)
+                folder, name = os.path.split(p)
+                known = self.snapshot.get(folder)
+                if known is not None and name not in known[1]:
+                    known[1].append(name)
+                    self.changed.add(folder)
+        return stable
+
+    def _walk(self):
+        """
+        List the folders one at a time, yielding (folder, new paths).
+        """
+        stack = [('', None)]
+        while stack:
+            folder, st = stack.pop()
+            files, folders = self._try_list_folder(folder, st)
+            yield folder, files
+            stack.extend(folders)
+
+    def _walk_parallel(self):
+        """
+        List the folders on `workers` threads, yielding (folder, new paths)
+        as they are listed. At most QUEUE_SIZE listings are held waiting
+        for the consumer, the workers wait for it when the queue is full.
+        """
+        listings = queue.Queue(maxsize=QUEUE_SIZE)
+        stop = Event()
+        lock = Lock()
+        pending = [1]  # folders submitted but not yet listed
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    listings.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        def visit(folder, st):
+            try:
+                if stop.is_set():
+                    return
+                files, folders = self._try_list_folder(folder, st)
+                with lock:
+                    pending[0] += len(folders)
+                for sub_folder, sub_st in folders:
+                    pool.submit(visit, sub_folder, sub_st)
+                put((folder, files))
+            finally:
+                with lock:
+                    pending[0] -= 1
+                    done = pending[0] == 0
+                if done:
+                    put(None)
+
+        pool.submit(visit, '', None)
+        try:
+            while True:
+                item = listings.get()
+                if item is None:
+                    break
+                yield item
+        finally:
+            stop.set()
+            pool.shutdown(wait=False)
+
+    def _try_list_folder(self, folder, st=None):
+        try:
+            return self._list_folder(folder, st)
+        except OSError as e:
+            logging.warning("Could not scan %s (%s)", folder or self.basepath, str(e))
+            return [], []
+
+    def _list_folder(self, folder, st=None):
+        """
+        Return the paths of the new, stable files in `folder`, and its sub
+        folders as (path, stat result or None) to scan next.
+        """
+        full_path = os.path.join(self.basepath, folder)
+        if st is None:
+            st = os.stat(full_path)
+        known = self.snapshot.get(folder)
+        if known is not None and known[0] == st.st_mtime:
+            return [], [(os.path.join(folder, d), None) for d in known[2]]
+
+        seen = set(known[1]) if known is not None else set()
+        files, new_paths, folders = [], [], []
+        held = False
+        with os.scandir(full_path) as it:
+            for de in it:
+                if de.is_dir():
+                    if not de.is_symlink():
+                        folders.append((os.path.join(folder, de.name), de.stat()))
+                    continue
+                p = os.path.join(folder, de.name)
+                if de.name not in seen and self._wanted(p):
+                    try:
+                        if not self._is_stable(p, de.stat()):
+                            held = True
+                            continue
+                    except FileNotFoundError:
+                        continue
+                    new_paths.append(p)
+                files.append(de.name)
+
+        mtime = st.st_mtime
+        if held or time.time() - mtime < MTIME_GRACE:
+            # List it again next time, the folder may change again within
+            # the same mtime tick and pending files are not kept on restart
+            mtime = None
+        self.snapshot[folder] = (mtime, files, [os.path.basename(d) for d, _ in folders])
+        self.changed.add(folder)
+        return new_paths, folders
+
+
+def load_snapshot(location_id):
+    with get_db().transaction() as t:
+        folders = t.query(_ScannedFolder).filter(
+            _ScannedFolder.location_id == location_id
+        ).all()
+        snapshot = {}
+        for folder in folders:
+            data = json.loads(folder.data)
+            snapshot[folder.path] = (folder.mtime, data['files'], data['folders'])
+        return snapshot
+
+
+def save_snapshot(location_id, snapshot, changed, removed):
+    with get_db().transaction() as t:
+        if removed:
+            t.query(_ScannedFolder).filter(
+                _ScannedFolder.location_id == location_id,
+                _ScannedFolder.path.in_(list(removed)),
+            ).delete(synchronize_session=False)
+        if changed:
+            t.query(_ScannedFolder).filter(
+                _ScannedFolder.location_id == location_id,
+                _ScannedFolder.path.in_(list(changed)),
+            ).delete(synchronize_session=False)
+            t.add_all([
+                _ScannedFolder(
+                    location_id=location_id,
+                    path=path,
+                    mtime=snapshot[path][0],
+                    data=json.dumps({'files': snapshot[path][1], 'folders': snapshot[path][2]}),
+                ) for path in changed
+            ])
+
+
+# LOCAL FOLDER WATCHER
+######################
+
+
+class FolderWatcher(object):
+    """
+    A recursive folder watcher using inotify. Reports files that are closed
+    after writing or moved into the folder tree, with the same extension
+    and hidden file rules as FolderScanner. Raises OSError if inotify is
+    not available.
+
+    If the kernel event queue overflows, events are lost and `overflowed`
+    is set, telling the caller to fall back on a full scan.
+    """
+    MASK = (
+        inotify.IN_CLOSE_WRITE |
+        inotify.IN_MOVED_TO |
+        inotify.IN_CREATE |
+        inotify.IN_ONLYDIR
+    )
+
+    def __init__(self, basepath, ext=None):
+        self.basepath = basepath
+        self.ext = ext
+        self.inotify = inotify.Inotify()
+        self.watches = {}  # wd -> folder relative to basepath
+        self.overflowed = False
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        self._watch_tree('')
+
+    def _watch_tree(self, folder):
+        """
+        Watch `folder` and everything below it. Returns the files already
+        in there, since they were not seen being written.
+        """
+        found = []
+        for r, ds, fs in os.walk(os.path.join(self.basepath, folder)):
+            try:
+                wd = self.inotify.add_watch(r, self.MASK)
+            except OSError as e:
+                logging.warning("Could not watch %s (%s)", r, str(e))
+                continue
+            self.watches[wd] = os.path.relpath(r, self.basepath)
+            found.extend(os.path.join(r, f) for f in fs)
+        return [p for p in (os.path.relpath(f, self.basepath) for f in found) if self._wanted(p)]
+
+    def _wanted(self, p):
+        if self.ext and p.split('.')[-1].lower() not in self.ext:
+            return False
+        return not p.startswith('.')
+
+    def interrupt(self):
+        """
+        Make a waiting `read` return right away.
+        """
+        try:
+            os.write(self.wake_w, b'!')
+        except BlockingIOError:
+            pass
+
+    def read(self, timeout=None):
+        """
+        Wait at most `timeout` seconds for new files and return their paths.
+        """
+        events = self.inotify.read(timeout=timeout, wake_fd=self.wake_r)
+        try:
+            while os.read(self.wake_r, 64):
+                pass
+        except BlockingIOError:
+            pass
+
+        paths = []
+        for wd, mask, cookie, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                logging.warning("Lost watch events for %s", self.basepath)
+                self.overflowed = True
+                continue
+            if mask & inotify.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            folder = self.watches.get(wd)
+            if folder is None or not name:
+                continue
+            p = os.path.normpath(os.path.join(folder, name))
+            if mask & inotify.IN_ISDIR:
+                if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    paths.extend(self._watch_tree(p))
+            elif mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+                if self._wanted(p):
+                    paths.append(p)
+        return paths
+
+    def close(self):
+        self.inotify.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
 
 
 # SCANNER MANAGER
@@ -91,64 +449,167 @@ class FolderScanner(object):
 class Manager:
     """
     A Thread+Event based Scanner Manager that keeps one thread per folder
-    and trigs a new scan upon the trig method being called.
+    and trigs a new scan upon notifications on the `bus.SCAN` topic, or
+    every `idle_wakeup` seconds.
+
+    Locations with `watch` set in their config section are watched with
+    inotify instead, with a full scan every `reconcile_interval` seconds
+    to catch anything the watcher missed.
 
     There should only be one of these.
     """
-    def __init__(self):
+    def __init__(self, idle_wakeup=IDLE_WAKEUP):
         self.events = {}
-        trig_scan.manager = self
+        self.watchers = {}
+        self.idle_wakeup = int(idle_wakeup) or None
 
         for location in get_locations_by_type(*SCANNABLE).entries:
             logging.debug("Setting up scanner thread [Scanner%i]", location.id)
             event = Event()
             self.events[location.id] = event
+            watcher = None
+            if location.metadata.watch:
+                try:
+                    watcher = FolderWatcher(location.metadata.folder)
+                    self.watchers[location.id] = watcher
+                except OSError as e:
+                    logging.warning(
+                        "Could not watch location %i, scanning instead (%s)",
+                        location.id, str(e)
+                    )
             thread = Thread(
                 target=scanning_loop,
                 name="Scanner%i" % (location.id),
-                args=(event, location)
+                args=(event, location, self.idle_wakeup, watcher)
             )
             thread.daemon = True
             thread.start()
 
+        bus.subscribe(bus.SCAN, self.trig)
+
     def trig(self, location_id):
         event = self.events.get(location_id)
         if event is None:
-            raise ValueError("No thread for location %i", location_id)
+            logging.debug("No scanner thread for location %i", location_id)
+            return
         logging.info("Triggering scanner event for location %i", location_id)
         event.set()
+        if location_id in self.watchers:
+            self.watchers[location_id].interrupt()
 
 
-def scanning_loop(scan_event, location):
+def scanning_loop(scan_event, location, idle_wakeup=IDLE_WAKEUP, watcher=None):
     """
-    A scanning loop using FolderScanner. Will wait for scan_event to be set
-    each iteration.
+    A scanning loop using FolderScanner. Will wait for scan_event to be set,
+    or at most `idle_wakeup` seconds, each iteration.
+
+    With a FolderWatcher, the loop registers files as the watcher reports
+    them instead, and only scans at start, when trigged, when the watcher
+    lost events and every `reconcile_interval` seconds.
     """
     metadata = location.metadata
     logging.info("Started scanner thread for %i:%s", location.id, metadata.folder)
+    scanner = FolderScanner(
+        metadata.folder,
+        ext=None,
+        snapshot=load_snapshot(location.id),
+        workers=max(metadata.scan_workers or 1, 1),
+        settle=metadata.settle_time,
+    )
+    if watcher is None:
+        while True:
+            scan_event.wait(idle_wakeup)
+            scan_event.clear()
+
+            scan(location, scanner)
+
+    reconcile_interval = metadata.reconcile_interval
+    next_reconcile = 0
     while True:
-        scanner = FolderScanner(metadata.folder, ext=None)
+        if scan_event.is_set() or watcher.overflowed or time.monotonic() >= next_reconcile:
+            scan_event.clear()
+            watcher.overflowed = False
+            logging.debug("Reconciling watched location %i", location.id)
+            scan(location, scanner)
+            next_reconcile = time.monotonic() + reconcile_interval
 
-        scan_event.wait(30)
-        scan_event.clear()
+        filepaths = watcher.read(timeout=max(next_reconcile - time.monotonic(), 0))
+        register_files(location, filepaths)
 
-        for filepath in scanner.scan():
+
+def scan(location, scanner):
+    """
+    Register the new files found by `scanner` and store its snapshot.
+    """
+    register_files(location, scanner.scan(), known=KnownPaths(location.id))
+    if scanner.changed or scanner.removed:
+        save_snapshot(location.id, scanner.snapshot, scanner.changed, scanner.removed)
+
+
+def register_files(location, filepaths, known=None):
+    """
+    Create an `import_ready` entry for each file path not yet managed on
+    the location, and notify the importer. Returns the number of entries.
+
+    Paths are checked against `known`, a KnownPaths for the location, or
+    against the database, and registered in batches of BATCH_SIZE, one
+    transaction per batch.
+    """
+    created = 0
+    batch = []
+    for filepath in filepaths:
+        batch.append(filepath)
+        if len(batch) >= BATCH_SIZE:
+            created += _register_batch(location, batch, known)
+            batch = []
+    if batch:
+        created += _register_batch(location, batch, known)
+
+    if created:
+        bus.publish(bus.IMPORT, location.id, created)
+    return created
+
+
+def _register_batch(location, filepaths, known):
+    if known is not None:
+        new = known.filter_new(filepaths)
+    else:
+        managed = get_managed_paths(location.id, filepaths)
+        new = [p for p in filepaths if p not in managed]
+    if not new:
+        return 0
+
+    try:
+        create_entries([_make_entry(location, filepath) for filepath in new])
+    except _File.ConflictException:
+        # Someone else registered some of the files, take them one by one
+        logging.debug("Batch conflict on location %i, registering one by one", location.id)
+        created = 0
+        for filepath in new:
             try:
-                f = File(
-                    path=filepath,
-                    location=location,
-                    purpose=_File.Purpose.source,
-                )
-                f = create_file(f)
-                logging.info(f.to_json())
-                e = Entry(
-                    files=[f],
-                    import_location_id=location.id,
-                    state=_Entry.State.import_ready,
-                    user_id=metadata.user_id,
-                    tags=metadata.tags,
-                )
-                e = create_entry(e)
-                logging.info(e.to_json())
+                create_entries([_make_entry(location, filepath)])
+                created += 1
             except _File.ConflictException:
                 logging.debug("File '%s' is managed", filepath)
+        return created
+
+    logging.info("Registered %i files on location %i", len(new), location.id)
+    if known is not None:
+        for filepath in new:
+            known.add(filepath)
+    return len(new)
+
+
+def _make_entry(location, filepath):
+    return Entry(
+        files=[File(
+            path=filepath,
+            location=location,
+            purpose=_File.Purpose.source,
+        )],
+        import_location_id=location.id,
+        state=_Entry.State.import_ready,
+        user_id=location.metadata.user_id,
+        tags=location.metadata.tags,
+        priority=_Entry.Priority.low,
+    )
@@ -3,6 +3,7 @@ import configparser
 
 from samtt import init
 from .location import _Location
+from .migrate import migrate
 from .user import _User, password_hash
 from .location import get_location_by_name, update_location_by_id
 
@@ -36,9 +37,19 @@ class Setup:
         self.server_host = self.config['Server']['host']
         self.server_port = int(self.config['Server']['port'])
 
+    def get_options(self, section):
+        """
+        Return the options in an optional config section as a dict.
+        """
+        if not self.config.has_section(section):
+            return {}
+        return {k: v for k, v in self.config[section].items()}
+
     def create_database_tables(self):
         logging.info("Creating tables...")
         self.db.create_all()
+        logging.info("Migrating tables...")
+        migrate(self.db)
 
     def add_users(self):
         logging.info("Setting up users...")
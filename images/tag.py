@@ -1,7 +1,8 @@
 import bottle
 import random
+import collections
 
-from sqlalchemy import Column, String, Integer, ForeignKey
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, select, func
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.exc import NoResultFound
 from samtt import Base, get_db
@@ -22,18 +23,24 @@ from .types import PropertySet, Property
 class _Tag(Base):
     __tablename__ = 'tag'
 
-    id = Column(Integer, primary_key=True)
+    id = Column(String(128), primary_key=True)
     title = Column(String(128))
     color = Column(Integer, default=0)
+    count = Column(Integer, nullable=False, default=0)  # entries, see count_tags
     entries = relationship('_Entry', secondary='entry_to_tag')
 
 
 class _EntryToTag(Base):
     __tablename__ = 'entry_to_tag'
+    __table_args__ = (
+        # Tag filters in get_entries are semi-joins on this index
+        Index('entry_to_tag_unique', 'tag_id', 'entry_id', unique=True),
+        Index('entry_to_tag_entry', 'entry_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     entry_id = Column(Integer, ForeignKey('entry.id'))
-    tag_id = Column(Integer, ForeignKey('tag.id'))
+    tag_id = Column(String(128), ForeignKey('tag.id'))
 
 
 # DESCRIPTOR
@@ -42,6 +49,7 @@ class _EntryToTag(Base):
 
 class Tag(PropertySet):
     id = Property()
+    count = Property(int)
     color_id = Property(int)
     background_color = Property()
     foreground_color = Property()
@@ -70,7 +78,7 @@ class App:
             callback=Fetch(get_tags),
         )
         app.route(
-            path='/<id:int>',
+            path='/<id>',
             callback=FetchById(get_tag_by_id),
         )
         app.route(
@@ -102,6 +110,7 @@ def get_tags():
             entries=[
                 Tag(
                     id=tag.id,
+                    count=tag.count,
                     color_id=tag.color,
                     background_color=colors[tag.color][0],
                     foreground_color=colors[tag.color][1],
@@ -117,6 +126,7 @@ def get_tag_by_id(id):
 
         return Tag(
             id=tag.id,
+            count=tag.count,
             color_id=tag.color,
             background_color=colors[tag.color][0],
             foreground_color=colors[tag.color][1],
@@ -161,6 +171,57 @@ def ensure_tag(tag_id):
             t.add(tag)
 
 
+def ensure_tags(tag_ids):
+    """
+    Like `ensure_tag` for many tags at once, with one query for the
+    existing tags and one insert for the missing ones.
+    """
+    tag_ids = set(tag_ids)
+    if not tag_ids:
+        return
+
+    with get_db().transaction() as t:
+        existing = set(
+            row.id for row in t.query(_Tag.id).filter(_Tag.id.in_(list(tag_ids)))
+        )
+        missing = [
+            {'id': tag_id, 'color': random.randrange(0, len(colors))}
+            for tag_id in sorted(tag_ids - existing)
+        ]
+        if missing:
+            t.execute(_Tag.__table__.insert(), missing)
+
+
+def count_tags(t, tag_ids, delta):
+    """
+    Adjust the maintained entry count of each tag in `tag_ids` by `delta`,
+    once per occurrence, within the transaction `t`.
+    """
+    occurrences = collections.Counter(tag_ids)
+    by_n = collections.defaultdict(list)
+    for tag_id, n in occurrences.items():
+        by_n[n].append(tag_id)
+    for n, ids in by_n.items():
+        t.query(_Tag).filter(_Tag.id.in_(ids)).update(
+            {_Tag.count: _Tag.count + n * delta},
+            synchronize_session=False,
+        )
+
+
+def recount_tags(t):
+    """
+    Recompute the maintained entry counts of all tags from entry_to_tag.
+    """
+    t.query(_Tag).update(
+        {_Tag.count: (
+            select([func.count(_EntryToTag.id)])
+            .where(_EntryToTag.tag_id == _Tag.id)
+            .as_scalar()
+        )},
+        synchronize_session=False,
+    )
+
+
 colors = [
     # Background Foreground Name
     ('#000000', '#ffffff', 'Black'),
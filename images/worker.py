@@ -0,0 +1,66 @@
+"""Standalone import worker, for running imports on other hosts than the web app"""
+
+import os
+import time
+import logging
+import argparse
+
+from .setup import Setup
+
+from . import scanner
+from . import importer
+from . import entry
+from .ingest import image
+
+
+if __name__ == '__main__':
+    # Options
+    parser = argparse.ArgumentParser(usage="images.worker")
+    parser.add_argument(
+        '-c', '--config',
+        default=os.getenv('IMAGES_CONFIG', 'images.ini'),
+        help='specify what config file to run on')
+    parser.add_argument(
+        '-g', '--debug', action="store_true",
+        help='show debug messages')
+    parser.add_argument(
+        '-l', '--location', action="append",
+        help='only import for this location (may be given more than once)')
+    parser.add_argument(
+        '--scan', action="store_true",
+        help='also run scanner threads for the scannable locations')
+    parser.add_argument(
+        '--backfill-properties', action="store_true",
+        help='index the promoted metadata properties of all entries, then exit')
+
+    args = parser.parse_args()
+
+    # Config and Database
+    # The web app owns the users and locations. The schema is migrated by
+    # whichever of the web app and the workers is upgraded and started
+    # first, so that a worker never runs against columns it does not know.
+    setup = Setup(args.config, debug=args.debug)
+    setup.create_database_tables()
+
+    if args.backfill_properties:
+        logging.info("*** Backfilling promoted properties...")
+        count = entry.backfill_entry_properties()
+        logging.info("*** Done, %i entries have promoted properties.", count)
+        raise SystemExit(0)
+
+    # Setting up workers
+    logging.info("*** Setting up Workers...")
+    managers = []
+    options = setup.get_options('Importer')
+    options.setdefault('idle_wakeup', importer.WORKER_IDLE_WAKEUP)
+    if args.location:
+        options['locations'] = args.location
+    logging.info("Starting %s manager..." % (importer.__name__))
+    managers.append(importer.Manager(**options))
+    if args.scan:
+        logging.info("Starting %s manager..." % (scanner.__name__))
+        managers.append(scanner.Manager(**setup.get_options('Scanner')))
+    logging.info("*** Done setting up Workers.")
+
+    while True:
+        time.sleep(3600)
@@ -41,7 +41,7 @@ setup(
     install_requires=[
         "pillow>=2.5.1",
         "bottle>0.12.7",
-        "sqlalchemy>=1.0.0",
+        "sqlalchemy>=1.2.0",
     ],
     tests_require=[
         "behave>=1.2.4",